@@ -14,14 +14,15 @@ class APIQuerySet:
         self.query = query
         self.params = params
         self.count = 0
-        self.execute()
+        # only interested in count here ; pages are fetched on slicing
+        self.execute(limit=1)
 
     def execute(self, skip=None, limit=None):
-        success, code, response = query_api(
-            GET, self.query, params={"skip": skip, "limit": limit}
-        )
+        params = dict(self.params)
+        params.update({"skip": skip, "limit": limit})
+        success, code, response = query_api(GET, self.query, params=params)
         if success and "items" in response:
-            self.count = response["meta"]["count"]
+            self.count = response["meta"]["count"] or 0
             return self.process(response.get("items", []))
         else:
             self.count = 0
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""Load-test creator polling (`GET /tasks/creator`) with 1, 4 and 8 uwsgi workers
+
+Starts the scheduler app under uwsgi for each number of processes (same
+`JWT_SECRET` for all) against `MONGODB_URI`, then has `--clients` concurrent
+creators poll for available tasks during `--duration` seconds.
+Tokens are requested on the first run and reused on the next ones.
+
+    MONGODB_URI=mongodb://localhost python bench-creator-polling.py \\
+        --username creator --password creator --processes 1 4 8
+"""
+
+import argparse
+import concurrent.futures
+import os
+import pathlib
+import secrets
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+SRC = pathlib.Path(__file__).parent.parent.joinpath("src").resolve()
+
+
+def start_server(nb_processes, port, secret):
+    env = dict(os.environ)
+    env.update({"JWT_SECRET": secret, "UWSGI_INI": ""})
+    server = subprocess.Popen(
+        [
+            shutil.which("uwsgi") or "uwsgi",
+            "--http",
+            f"127.0.0.1:{port}",
+            "--chdir",
+            str(SRC),
+            "--module",
+            "main",
+            "--callable",
+            "flask",
+            "--master",
+            "--enable-threads",
+            "--need-app",
+            "--processes",
+            str(nb_processes),
+            "--disable-logging",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"uwsgi exited with {server.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return server, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("uwsgi did not start in 30s")
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def get_token(url, username, password):
+    resp = requests.post(
+        f"{url}/auth/authorize",
+        headers={"username": username, "password": password},
+        timeout=10,
+    )
+    resp.raise_for_status()
+    return resp.json()["access_token"]
+
+
+def poll(url, token, stop, durations, errors):
+    session = requests.Session()
+    session.headers.update({"token": token})
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            resp = session.get(
+                f"{url}/tasks/creator", params={"fields": "summary"}, timeout=30
+            )
+            resp.raise_for_status()
+        except requests.RequestException:
+            errors.append(1)
+            continue
+        durations.append(time.perf_counter() - start)
+
+
+def run(nb_processes, args, secret, tokens):
+    server, url = start_server(nb_processes, args.port, secret)
+    try:
+        if args.username not in tokens:
+            tokens[args.username] = get_token(url, args.username, args.password)
+        # warm-up: every worker opens its MongoDB pool
+        for _ in range(nb_processes * 4):
+            requests.get(
+                f"{url}/tasks/creator",
+                params={"fields": "summary"},
+                headers={"token": tokens[args.username]},
+                timeout=30,
+            )
+
+        stop = threading.Event()
+        durations, errors = [], []
+        with concurrent.futures.ThreadPoolExecutor(args.clients) as executor:
+            for _ in range(args.clients):
+                executor.submit(
+                    poll, url, tokens[args.username], stop, durations, errors
+                )
+            time.sleep(args.duration)
+            stop.set()
+    finally:
+        stop_server(server)
+
+    if not durations:
+        print(f"processes={nb_processes:<3} no successful request ({len(errors)=})")
+        return
+    durations.sort()
+    print(
+        f"processes={nb_processes:<3} "
+        f"requests={len(durations)} "
+        f"rps={len(durations) / args.duration:.1f} "
+        f"median={statistics.median(durations) * 1000:.2f}ms "
+        f"p95={durations[int(len(durations) * 0.95)] * 1000:.2f}ms "
+        f"p99={durations[int(len(durations) * 0.99)] * 1000:.2f}ms "
+        f"errors={len(errors)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--username", required=True, help="creator account")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--clients", type=int, default=32, help="concurrent pollers")
+    parser.add_argument("--duration", type=int, default=20, help="seconds per run")
+    parser.add_argument("--port", type=int, default=28001)
+    args = parser.parse_args()
+
+    if not shutil.which("uwsgi"):
+        print("uwsgi not found in PATH (pip install uwsgi)")
+        return 1
+
+    secret = secrets.token_urlsafe(32)
+    tokens = {}
+    for nb_processes in args.processes:
+        run(nb_processes, args, secret, tokens)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Compare per-request latency and open connections: client-per-call vs pooled
+
+Simulates the queries of a `PATCH /tasks/<type>/<id>/status` request (a dozen
+collection handles, each issuing a `find_one`) against `MONGODB_URI`.
+
+    MONGODB_URI=mongodb://localhost python bench-mongo-pool.py --requests 200
+"""
+
+import argparse
+import gc
+import pathlib
+import statistics
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath("src")))
+
+from utils import mongo  # noqa: E402
+
+# collections touched while handling a single status update
+REQUEST_COLLECTIONS = [
+    "creator_tasks",
+    "creator_tasks",
+    "creator_tasks",
+    "orders",
+    "orders",
+    "orders",
+    "creator_tasks",
+    "downloader_tasks",
+    "writer_tasks",
+    "users",
+    "channels",
+    "uploaded_files",
+]
+
+
+def open_connections(client) -> int:
+    return client.admin.command("serverStatus")["connections"]["current"]
+
+
+def request_with_new_clients():
+    """previous behavior: a new MongoClient for every collection handle"""
+    for name in REQUEST_COLLECTIONS:
+        MongoClient(host=mongo.MONGODB_URI)["Cardshop"][name].find_one({})
+
+
+def request_with_pool():
+    for name in REQUEST_COLLECTIONS:
+        mongo.Pool.database()[name].find_one({})
+
+
+def run(label, func, nb_requests, observer):
+    gc.collect()
+    before = open_connections(observer)
+    durations = []
+    peak = before
+    for index in range(nb_requests):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+        if index % 10 == 0:
+            peak = max(peak, open_connections(observer))
+    after = open_connections(observer)
+    print(
+        f"{label:<12} "
+        f"median={statistics.median(durations) * 1000:.2f}ms "
+        f"p95={sorted(durations)[int(len(durations) * 0.95)] * 1000:.2f}ms "
+        f"connections: before={before} peak={max(peak, after)} after={after}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100)
+    args = parser.parse_args()
+
+    observer = MongoClient(host=mongo.MONGODB_URI)
+    run("new-clients", request_with_new_clients, args.requests, observer)
+    run("pooled", request_with_pool, args.requests, observer)
+    mongo.Pool.close()
+    observer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import datetime
+import functools
 import logging
 import os
 import pathlib
+import signal
+import threading
+import time
 from collections.abc import Sequence
-from contextlib import contextmanager
 from typing import Optional
 
 import requests
@@ -11,7 +14,16 @@ import yaml
 from babel.dates import format_datetime
 from babel.support import Translations
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from utils.mongo import Acknowlegments, Channels, Orders, Users, WriterTasks
+from utils import metrics
+from utils.mongo import (
+    Acknowlegments,
+    Channels,
+    Configs,
+    Emails,
+    Orders,
+    Users,
+    WriterTasks,
+)
 from utils.templates import (
     country_name,
     get_add_shipment_url,
@@ -37,30 +49,46 @@ logger = logging.getLogger(__name__)
 
 
 locale_dir = pathlib.Path(__file__).parent.joinpath("locale")
-jinja_env = Environment(
-    loader=FileSystemLoader("templates"),
-    autoescape=select_autoescape(["html", "xml", "txt"]),
-    extensions=["jinja2.ext.i18n"],  #  "jinja2.ext.autoescape", "jinja2.ext.with_"
-)
 
 
 def format_dt(date, fmt="long", locale=None):
-    return format_datetime(
-        date, fmt, locale=locale or getattr(jinja_env, "_locale", "en_GB")
+    return format_datetime(date, fmt, locale=locale or "en_GB")
+
+
+JINJA_FILTERS = {
+    "id": get_id,
+    "yesno": yesno,
+    "pub_url": get_pub_url,
+    "insert_card_url": get_insert_card_url,
+    "add_shipment_url": get_add_shipment_url,
+    "public_download_urls": get_public_download_urls,
+    "public_download_torrent_urls": get_public_download_torrent_urls,
+    "country": country_name,
+    "language": language_name,
+    "linebreaksbr": linebreaksbr,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_translations(lang):
+    return Translations.load(locale_dir, [lang])
+
+
+@functools.lru_cache(maxsize=None)
+def get_jinja_env(lang):
+    """jinja environment for a language (templates are compiled once per language)"""
+    env = Environment(
+        loader=FileSystemLoader("templates"),
+        autoescape=select_autoescape(["html", "xml", "txt"]),
+        extensions=["jinja2.ext.i18n"],  #  "jinja2.ext.autoescape", "jinja2.ext.with_"
     )
+    env.filters.update(JINJA_FILTERS)
+    env.filters["date"] = functools.partial(format_dt, locale=lang)
+    env.install_gettext_translations(get_translations(lang))
+    return env
 
 
-jinja_env.filters["id"] = get_id
-jinja_env.filters["yesno"] = yesno
-jinja_env.filters["pub_url"] = get_pub_url
-jinja_env.filters["insert_card_url"] = get_insert_card_url
-jinja_env.filters["add_shipment_url"] = get_add_shipment_url
-jinja_env.filters["public_download_urls"] = get_public_download_urls
-jinja_env.filters["public_download_torrent_urls"] = get_public_download_torrent_urls
-jinja_env.filters["country"] = country_name
-jinja_env.filters["language"] = language_name
-jinja_env.filters["linebreaksbr"] = linebreaksbr
-jinja_env.filters["date"] = format_dt
+jinja_env = get_jinja_env("en_GB")
 
 
 CLIENT_EMAIL_STATUSES = [
@@ -77,19 +105,11 @@ CLIENT_EMAIL_STATUSES = [
 RECIPIENT_EMAIL_STATUSES = [Orders.shipped]
 
 FAILED_ORDER_EMAIL = os.getenv("FAILED_ORDER_EMAIL")
-
-
-@contextmanager
-def localized_for(lang, *args, **kwargs):
-    translations = Translations.load(locale_dir, [lang])
-    if lang == "en":
-        lang == "en_GB"
-    try:
-        jinja_env._locale = lang
-        yield jinja_env.install_gettext_translations(translations)
-    finally:
-        jinja_env.uninstall_gettext_translations(translations)
-        jinja_env._locale = "en_GB"
+# outbox sender: max emails sent per minute, attempts and delay before first retry
+EMAILS_PER_MINUTE = int(os.getenv("EMAILS_PER_MINUTE") or 60)
+EMAILS_MAX_ATTEMPTS = int(os.getenv("EMAILS_MAX_ATTEMPTS") or 8)
+EMAILS_RETRY_SECONDS = int(os.getenv("EMAILS_RETRY_SECONDS") or 60)
+EMAILS_POLL_SECONDS = int(os.getenv("EMAILS_POLL_SECONDS") or 5)
 
 
 def send_email_via_api(
@@ -178,10 +198,13 @@ def send_email(
     except Exception as exp:
         logger.error("Unable to send email: {}".format(exp))
         logger.exception(exp)
+        raise
 
 
-def get_full_context(order_id, extra: Optional[dict] = None):
-    order = Orders().get_with_tasks(order_id, {"logs": 0})
+def get_full_context(order, extra: Optional[dict] = None):
+    order = dict(order)
+    Configs.expand([order], fields=("config",))
+    order_id = str(order["_id"])
     order.update(
         {
             "id": order_id,
@@ -199,7 +222,7 @@ def get_order_status_update_template(status):
     return "email_order_{}.html".format(status)
 
 
-def get_email_for(order_id, kind, formatted=True):
+def get_email_for(order, kind, formatted=True):
     def _fmt(name, email):
         return "{name} <{email}>".format(name=name, email=email)
 
@@ -209,7 +232,6 @@ def get_email_for(order_id, kind, formatted=True):
     if kind == "error-manager" and FAILED_ORDER_EMAIL:
         return _fmt("Imager Error Manager", FAILED_ORDER_EMAIL), "en_GB"
 
-    order = Orders.get_with_tasks(order_id, {"logs": 0})
     if kind == "client":
         return (
             _fmt(order["client"]["name"], order["client"]["email"]),
@@ -245,6 +267,24 @@ def get_dashboard_entries(yaml_text):
     ]
 
 
+@functools.lru_cache(maxsize=256)
+def get_stored_dashboard_entries(config_yaml_hash):
+    """dashboard entries of a stored YAML config (content of a hash never changes)"""
+    (document,) = Configs.expand(
+        [{"config_yaml_hash": config_yaml_hash}], fields=("config_yaml",)
+    )
+    return tuple(get_dashboard_entries(document["config_yaml"]))
+
+
+def get_order_entries(order):
+    try:
+        if order.get("config_yaml_hash"):
+            return list(get_stored_dashboard_entries(order["config_yaml_hash"]))
+        return get_dashboard_entries(order["config_yaml"])
+    except Exception:
+        return order["config"]["content"]["zims"]
+
+
 def send_order_email_for(
     order_id,
     subject_tmpl,
@@ -256,22 +296,15 @@ def send_order_email_for(
     extra: Optional[dict] = None,
     on: Optional[datetime.datetime] = None,
 ):
-    to, lang = get_email_for(order_id, kind=to)
-    with localized_for(lang):
-        context = get_full_context(str(order_id), extra=extra)
-        try:
-            context["order_entries"] = get_dashboard_entries(
-                context["order"]["config_yaml"]
-            )
-        except:
-            context["order_entries"] = context["order"]["config"]["content"]["zims"]
+    # single load of the order for all recipients and the content
+    order = Orders.get_with_tasks(order_id, fields="email")
+    to, lang = get_email_for(order, kind=to)
+    env = get_jinja_env(lang)
+    context = get_full_context(order, extra=extra)
+    context["order_entries"] = get_order_entries(context["order"])
 
-        subject = jinja_env.get_template("{}.txt".format(subject_tmpl)).render(
-            **context
-        )
-        content = jinja_env.get_template("{}.html".format(content_tmpl)).render(
-            **context
-        )
+    subject = env.get_template("{}.txt".format(subject_tmpl)).render(**context)
+    content = env.get_template("{}.html".format(content_tmpl)).render(**context)
 
     cc = ([cc] if isinstance(cc, str) else cc) or []
     bcc = ([bcc] if isinstance(bcc, str) else bcc) or []
@@ -279,8 +312,8 @@ def send_order_email_for(
         to=to,
         subject=subject,
         contents=content,
-        cc=[get_email_for(order_id, kind=item)[0] for item in cc],
-        bcc=[get_email_for(order_id, kind=item)[0] for item in bcc],
+        cc=[get_email_for(order, kind=item)[0] for item in cc],
+        bcc=[get_email_for(order, kind=item)[0] for item in bcc],
         attachments=attachments or {},
         on=on,
     )
@@ -305,10 +338,11 @@ def send_order_failed_email(order_id):
     )
 
     # operator: download/write failed, please check conn and SD and contact client
-    order = Orders().get_with_tasks(order_id, {"logs": 0})
-    if order["tasks"].get("write") and order["tasks"]["write"]["status"] in (
-        WriterTasks.failed_to_download,
-        WriterTasks.failed_to_write,
+    order = Orders().get_with_tasks(order_id, fields="status")
+    if any(
+        task["status"] in (WriterTasks.failed_to_download, WriterTasks.failed_to_write)
+        for task in order["tasks"].get("write") or []
+        if task
     ):
         send_order_email_for(
             order_id, "subject_order_failed", "operator_order_failed", "operator"
@@ -406,9 +440,9 @@ def send_worker_sos_email(ack_id):
 
 
 def build_shipping_document(order_id):
-    order = Orders().get(order_id, {"logs": 0})
+    order = Orders.get_with_tasks(order_id, fields="email")
     channel = Channels().get(order["channel"])
-    context = get_full_context(str(order_id), extra={"channel": channel})
+    context = get_full_context(order, extra={"channel": channel})
     context.update({"cwd": os.path.abspath(".")})
 
     fname = "Shipping_{oid}.pdf".format(oid=context["order"]["min_id"])
@@ -424,3 +458,100 @@ def build_shipping_document(order_id):
     }
     # pdfkit.from_string(content, fpath, options=options)
     return fpath
+
+
+# senders that can be queued, by name
+OUTBOX_SENDERS = {
+    func.__name__: func
+    for func in (
+        send_order_created_email,
+        send_order_failed_email,
+        send_image_uploaded_email,
+        send_image_uploaded_public_email,
+        send_insert_card_email,
+        send_image_writing_email,
+        send_image_written_email,
+        send_order_pending_shipment_email,
+        send_order_shipped_email,
+        send_worker_sos_email,
+    )
+}
+
+
+def queue_email(
+    sender,
+    *args,
+    on: Optional[datetime.datetime] = None,
+    key: Optional[str] = None,
+) -> bool:
+    """queue a call to sender(*args) in outbox, returning whether it's new
+
+    Same key is only queued (thus sent) once while stored. It defaults to
+    sender, args and `on`: when the status triggering the email was entered.
+    Without it, the email is sent only once for those args."""
+    if sender.__name__ not in OUTBOX_SENDERS:
+        raise ValueError(f"{sender.__name__} can't be queued")
+    if key is None:
+        key = ":".join(
+            [sender.__name__]
+            + [str(arg) for arg in args]
+            + ([on.isoformat()] if on else [])
+        )
+    return Emails.queue(sender=sender.__name__, args=args, key=key)
+
+
+def send_next_email() -> bool:
+    """send oldest due email from outbox, returning whether there was one
+
+    Failed attempts are retried with exponential backoff, up to
+    EMAILS_MAX_ATTEMPTS."""
+    email = Emails.claim_next(claim_for=EMAILS_RETRY_SECONDS * 10)
+    if email is None:
+        return False
+
+    try:
+        OUTBOX_SENDERS[email["sender"]](*email["args"])
+    except Exception as exc:
+        retry_on = None
+        if email["attempts"] < EMAILS_MAX_ATTEMPTS:
+            retry_on = datetime.datetime.now() + datetime.timedelta(
+                seconds=EMAILS_RETRY_SECONDS * 2 ** (email["attempts"] - 1)
+            )
+        logger.error(
+            f"Failed to send {email['key']} (attempt #{email['attempts']}), "
+            f"{f'retrying on {retry_on}' if retry_on else 'giving up'}: {exc!s}"
+        )
+        Emails.set_failed(email["_id"], error=str(exc), retry_on=retry_on)
+        metrics.EMAILS_FAILED.inc(sender=email["sender"])
+    else:
+        Emails.set_sent(email["_id"])
+        metrics.EMAILS_SENT.inc(sender=email["sender"])
+    return True
+
+
+def run_sender():
+    """send emails from outbox until stopped, at most EMAILS_PER_MINUTE"""
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    logger.info("Sending emails from outbox…")
+    interval = 60 / EMAILS_PER_MINUTE
+    while not stopping.is_set():
+        started_on = time.monotonic()
+        try:
+            sent = send_next_email()
+        except Exception as exc:
+            # DB unreachable?
+            logger.error(f"Failed to get next email: {exc!s}")
+            sent = False
+        if sent:
+            stopping.wait(max(0, interval - (time.monotonic() - started_on)))
+        else:
+            stopping.wait(EMAILS_POLL_SECONDS)
+    logger.info("Stopped sending emails")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_sender()
@@ -13,6 +13,7 @@ from routes import (
     channels,
     errors,
     home,
+    metrics,
     orders,
     tasks,
     users,
@@ -50,11 +51,14 @@ flask.register_blueprint(warehouses.blueprint)
 flask.register_blueprint(workers.blueprint)
 flask.register_blueprint(autoimages.blueprint)
 flask.register_blueprint(woo.blueprint)
+flask.register_blueprint(metrics.blueprint)
 
 errors.register_handlers(flask)
+metrics.register_handlers(flask)
 
 
 if __name__ == "__main__":
+    # development server ; production is served by uwsgi workers (uwsgi.ini)
     Initializer.start()
 
     is_debug = os.getenv("DEBUG", False)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""move inline config and config_yaml of orders, creator tasks and auto-images
+to the (content-addressed) configs collection
+
+Progress is recorded after every batch so it can be interrupted and resumed.
+Running it again once done only goes through newer documents"""
+
+import argparse
+import logging
+
+from pymongo import ASCENDING, UpdateOne
+from utils.mongo import AutoImages, Configs, CreatorTasks, Migrations, Orders
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def migrate(collection_cls, batch_size):
+    name = f"configs.{collection_cls.collection_name}"
+    last_id = Migrations.get_checkpoint(name)
+    if last_id:
+        logger.info(f"{collection_cls.collection_name}: resuming after {last_id}")
+
+    nb_migrated = 0
+    while True:
+        batch = list(
+            collection_cls()
+            .find(
+                {"_id": {"$gt": last_id}} if last_id else {},
+                {field: 1 for field in Configs.FIELDS},
+            )
+            .sort([("_id", ASCENDING)])
+            .limit(batch_size)
+        )
+        if not batch:
+            break
+
+        requests = []
+        for document in batch:
+            inline = [field for field in Configs.FIELDS if field in document]
+            if not inline:
+                continue
+            requests.append(
+                UpdateOne(
+                    {"_id": document["_id"]},
+                    {
+                        "$set": Configs.dehydrate(
+                            {field: document[field] for field in inline}
+                        ),
+                        "$unset": {field: "" for field in inline},
+                    },
+                )
+            )
+        if requests:
+            nb_migrated += collection_cls().bulk_write(requests).modified_count
+
+        last_id = batch[-1]["_id"]
+        Migrations.set_checkpoint(name, last_id)
+        logger.info(f"{collection_cls.collection_name}: {nb_migrated} migrated")
+
+    Migrations.set_checkpoint(name, last_id, done=True)
+    return nb_migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore recorded progress"
+    )
+    args = parser.parse_args()
+
+    for collection_cls in (Orders, CreatorTasks, AutoImages):
+        if args.restart:
+            Migrations.reset(f"configs.{collection_cls.collection_name}")
+        migrate(collection_cls, args.batch_size)
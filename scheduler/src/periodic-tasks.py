@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 
+import argparse
 import datetime
 import logging
 import os
+import signal
+import socket
+import sys
+import threading
+import time
 from pathlib import Path
 from urllib.parse import urlsplit
 
-import humanfriendly
 import requests
-from emailing import send_order_failed_email
+from emailing import queue_email, send_order_failed_email
 from routes.orders import create_order_from
-from utils.files import FileChecker
-from utils.mongo import AutoImages, Orders, Tasks, UploadedFiles
+from utils import metrics
+from utils.files import FileChecker, process_files
+from utils.json import ensure_objectid
+from utils.mongo import (
+    AutoImages,
+    CreatorTasks,
+    DownloaderTasks,
+    Orders,
+    PeriodicJobs,
+    Tasks,
+    UploadedFiles,
+    WriterTasks,
+)
 from utils.templates import (
     get_public_download_torrent_urls,
     get_public_download_urls,
@@ -25,12 +41,15 @@ RECREATE_AUTO_MONTHLY = bool(os.getenv("RECREATE_AUTO_MONTHLY", "") == "y")
 SHOP_WOO_API_URL = os.getenv("SHOP_WOO_API_URL", "https://get.kiwix.org/")
 SHOP_WOO_CONSUMER_KEY = os.getenv("SHOP_WOO_CONSUMER_KEY", "not-set")
 SHOP_WOO_CONSUMER_SECRET = os.getenv("SHOP_WOO_CONSUMER_SECRET", "not-set")
-LAST_CHECKED_UPLOADED_ON = datetime.datetime.now() - datetime.timedelta(
-    days=2
-)  # in past
-LAST_EXTENDED_EXPIRATIONS_ON = datetime.datetime.now() - datetime.timedelta(
-    days=2
-)  # in past
+# uploaded files expiration is checked against storage (marker) this often
+UPLOADED_FILES_CHECK_DAYS = int(os.getenv("UPLOADED_FILES_CHECK_DAYS") or 7)
+UPLOADED_FILES_CHECK_BATCH = int(os.getenv("UPLOADED_FILES_CHECK_BATCH") or 200)
+# longest sleep of the runner between two checks for due jobs
+PERIODIC_TASKS_TICK = int(os.getenv("PERIODIC_TASKS_TICK") or 60)
+# jobs are leased for that long and renewed every third of it while running:
+# a job left by a dead replica is taken over by another once lease expired
+PERIODIC_LEASE_SECONDS = int(os.getenv("PERIODIC_LEASE_SECONDS") or 30)
+RUNNER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -54,74 +73,74 @@ def get_next_month():
     )
 
 
-def is_expired(status, since, size=0):
+def expire_orders():
     now = datetime.datetime.now()
-    min_bps = int(humanfriendly.parse_size("4MiB") / 8)
-
-    if status == Tasks.building:
-        return since < now - datetime.timedelta(hours=36)
-
-    if status == Tasks.wiping_sdcard:
-        return since < now - datetime.timedelta(minutes=30)
-
-    if status in (Tasks.uploading, Tasks.downloading, Tasks.writing):
-        return since < now - datetime.timedelta(seconds=int(size / min_bps))
-
 
-def run_periodic_tasks():
-    logger.info("running periodic tasks !!")
+    for order in Orders.all_pending_expiry():
+        ensure_lease()
+        ls = order["statuses"][-1]
 
-    # manage auto-images
-    logger.info("managing auto-images")
-    check_autoimages()
+        if not ls["status"] == Orders.pending_expiry:
+            continue  # wrong timing
 
-    extend_autoimages_expiration()
+        if not order["sd_card"]["expiration"] < now:
+            continue  # expiration not reached
 
-    delete_expired_files()
+        logger.info("Order #{} has reach expiration.".format(order["_id"]))
+        Orders().update_status(order["_id"], Orders.expired)
 
-    logger.info("timing out expired orders")
-    for task_cls, task in Tasks.all_inprogress():
-        task_id = task["_id"]
-        ls = task["statuses"][-1]
 
-        if not is_expired(ls["status"], ls["on"], task_cls.get_size(task_id)):
-            logger.info("skipping non-expired task #{}".format(task_id))
+def timeout_expired_tasks():
+    now = datetime.datetime.now()
+    for task_cls in (CreatorTasks, DownloaderTasks, WriterTasks):
+        # fence before timing out only: the cascade that follows must not be
+        # interrupted as timed out tasks wouldn't be found again on next run
+        ensure_lease(in_database=True)
+        timedout = task_cls.time_out_expired(now)
+        if not timedout:
             continue
-
-        logger.info("timing out task #{}".format(task_id))
-
-        order = Orders().get_with_tasks(task["order"])
-
-        # timeout task
-        task_cls.update_status(task_id=task_id, status=Tasks.timedout)
+        logger.info(
+            "timed out {} #{}".format(
+                task_cls.collection_name,
+                ", #".join(str(task["_id"]) for task in timedout),
+            )
+        )
+        failed_orders = {ensure_objectid(task["order"]) for task in timedout}
 
         # if write, cancel peers
-        if ls["status"] in (Tasks.wiping_sdcard, Tasks.writing):
-            for peer in order["tasks"]["write"]:
-                if peer["_id"] == task_id:
-                    continue
-                task_cls.update_status(task_id=peer["_id"], status=Tasks.canceled)
+        write_orders = [
+            ensure_objectid(task["order"])
+            for task in timedout
+            if task["status"] in (Tasks.wiping_sdcard, Tasks.writing)
+        ]
+        if write_orders:
+            peers = [
+                peer_id
+                for order in Orders().find(
+                    {"_id": {"$in": write_orders}}, {"tasks.write": 1}
+                )
+                for peer_id in order["tasks"].get("write", [])
+            ]
+            WriterTasks.transition_many(
+                {
+                    "_id": {
+                        "$in": peers,
+                        "$nin": [task["_id"] for task in timedout],
+                    }
+                },
+                Tasks.canceled,
+            )
 
         # cascade
-        task_cls.cascade_status(task_id=task_id, task_status=task_cls.timedout)
+        Orders.transition_many(
+            {"_id": {"$in": list(failed_orders)}}, Orders.failed, on=now
+        )
 
         # notify
-        send_order_failed_email(order["_id"])  # TODO: forward to task/order mgmt
-
-    logger.info("Marking orders as expired")
-    now = datetime.datetime.now()
-
-    for order in Orders.all_pending_expiry():
-        ls = order["statuses"][-1]
-
-        if not ls["status"] == Orders.pending_expiry:
-            continue  # wrong timing
-
-        if not order["sd_card"]["expiration"] < now:
-            continue  # expiration not reached
-
-        logger.info("Order #{} has reach expiration.".format(order["_id"]))
-        Orders().update_status(order["_id"], Orders.expired)
+        for order_id in failed_orders:
+            queue_email(
+                send_order_failed_email, order_id, on=now
+            )  # TODO: forward to task/order mgmt
 
 
 def set_product_download_urls(product_id: int, downloads):
@@ -134,9 +153,10 @@ def check_autoimages():
     # update images that were building
     logger.info("Looking for currently building images…")
     for image in AutoImages.all_currently_building():
+        ensure_lease()
         logger.info(f".. {image['slug']}")
         # check order status
-        order = Orders.get(image["order"])
+        order = Orders.get(image["order"], fields="status")
 
         # order is considered failed
         if order["status"] in Orders.FAILED_STATUSES:
@@ -199,9 +219,12 @@ def check_autoimages():
     # find images that must be recreated
     logger.info("Looking for images needing building…")
     for image in AutoImages.all_needing_rebuild():
+        ensure_lease()
         logger.info(f".. {image['slug']} ; starting build")
 
         payload = AutoImages.create_order_payload(image["slug"])
+        # an order (a build) must not be created twice for an image
+        ensure_lease(in_database=True)
         try:
             # retrieve up-to-date YAML from stored JSON config
             resp = requests.post(
@@ -227,50 +250,272 @@ def check_autoimages():
 def extend_autoimages_expiration():
     # extended file expiration for images needing it
     now = datetime.datetime.now()
-    if now < LAST_EXTENDED_EXPIRATIONS_ON + datetime.timedelta(days=1):
-        logger.debug(
-            f"Not extending uploaded files expiration ({LAST_EXTENDED_EXPIRATIONS_ON.isoformat()})"
-        )
-        return
-
     logger.info("Looking for files needing an expiration bump…")
 
+    renew_before = now + datetime.timedelta(days=FileChecker.extend_before_days)
+    files = []
     for image in AutoImages.all_ready():
-        logger.info(f"> {image['slug']}")
-        for file in AutoImages.get_uploaded_files(image["slug"]):
-            fc = FileChecker(file)
-            if fc.extend_if_expiring_soon():
-                logger.info(
-                    f".. extended by {fc.extend_for_days} days "
-                    f"from {fc.expire_on} "
-                    f"to {fc.next_expiration_on.isoformat()}"
-                )
-            else:
-                logger.debug(f".. deletion scheduled for {fc.expire_on.isoformat()}")
+        image_files = list(
+            UploadedFiles.all_expiring(
+                before=renew_before, download_urls=image.get("http_urls", [])
+            )
+        )
+        logger.info(f"> {image['slug']}: {len(image_files)} files expiring soon")
+        files += image_files
+
+    def extend(file):
+        fc = FileChecker(file)
+        if fc.extend_if_expiring_soon():
+            logger.info(
+                f".. {file['download_url']} extended by {fc.extend_for_days} days "
+                f"from {fc.expire_on} "
+                f"to {fc.next_expiration_on.isoformat()}"
+            )
+            return "extended"
+        logger.debug(f".. {file['download_url']} deletion scheduled for {fc.expire_on}")
+        return "unchanged"
+
+    process_files(files, extend, "Extended files expiration", stop=lease_lost)
+    ensure_lease()
 
 
 def delete_expired_files():
     now = datetime.datetime.now()
-    if now < LAST_CHECKED_UPLOADED_ON + datetime.timedelta(days=1):
-        logger.debug(
-            f"Not checking uploaded files ({LAST_CHECKED_UPLOADED_ON.isoformat()})"
-        )
-        return
     logger.info("Checking Uploaded files…")
 
     # remove entries that have been pending for a week
     a_week_ago = now - datetime.timedelta(days=7)
-    for file in UploadedFiles().find(
-        {"status": "pending", "created_on": {"$lte": a_week_ago}}
-    ):
+
+    def remove(file):
+        if lease_lost(in_database=True):
+            return "skipped"
         logger.info(f"Removing pending state {file['_id']!s}")
         FileChecker(file).remove_anyway()
+        return "removed"
 
-    for file in UploadedFiles().find({"status": "confirmed"}):
-        if FileChecker(file).remove_if_expired():
+    process_files(
+        UploadedFiles().find({"status": "pending", "created_on": {"$lte": a_week_ago}}),
+        remove,
+        "Removed pending files",
+        stop=lease_lost,
+    )
+    ensure_lease()
+
+    # record actual expiration of files not checked against storage lately
+    def reconcile(file):
+        return "checked" if FileChecker(file).reconcile() else "unreachable"
+
+    process_files(
+        UploadedFiles.all_unchecked_since(
+            now - datetime.timedelta(days=UPLOADED_FILES_CHECK_DAYS),
+            limit=UPLOADED_FILES_CHECK_BATCH,
+        ),
+        reconcile,
+        "Checked files expiration",
+        stop=lease_lost,
+    )
+    ensure_lease()
+
+    def remove_if_expired(file):
+        fc = FileChecker(file)
+        # confirm with marker before removing
+        if not fc.reconcile():
+            return "unreachable"
+        if lease_lost(in_database=True):
+            return "skipped"
+        if fc.remove_if_expired():
             logger.info(f"Removed expired file {file['_id']!s}")
+            return "removed"
+        return "extended"
+
+    process_files(
+        UploadedFiles.all_expired(now),
+        remove_if_expired,
+        "Removed expired files",
+        stop=lease_lost,
+    )
 
 
-if __name__ == "__main__":
-    if not DISABLE_PERIODIC_TASKS:
+# name: (function, interval, max duration) ; in seconds, in order of execution
+JOBS = {
+    "check-autoimages": (check_autoimages, 300, 3600),
+    "extend-expiration": (extend_autoimages_expiration, 86400, 6 * 3600),
+    "delete-expired-files": (delete_expired_files, 86400, 6 * 3600),
+    "timeout-tasks": (timeout_expired_tasks, 60, 600),
+    "expire-orders": (expire_orders, 300, 600),
+}
+
+stopping = threading.Event()
+
+
+class LeaseLost(Exception): ...
+
+
+class JobLease:
+    """lease on a periodic job, renewed in background while it runs
+
+    Renewal stops after the job's max duration (stuck job) so that another
+    replica can take over."""
+
+    def __init__(self, name: str, token: int, max_duration: int):
+        self.name = name
+        self.token = token
+        self.expire_on = time.monotonic() + PERIODIC_LEASE_SECONDS
+        self.deadline = time.monotonic() + max_duration
+        self.released = threading.Event()
+        self.lost = threading.Event()
+        self.renewer = threading.Thread(target=self.keep_renewing, daemon=True)
+        self.renewer.start()
+
+    def keep_renewing(self):
+        while not self.released.wait(PERIODIC_LEASE_SECONDS / 3):
+            if time.monotonic() > self.deadline:
+                logger.error(f"{self.name} exceeded its max duration, releasing")
+                self.lost.set()
+                return
+            renewed_on = time.monotonic()
+            try:
+                if not PeriodicJobs.renew(
+                    self.name, self.token, PERIODIC_LEASE_SECONDS
+                ):
+                    logger.error(f"{self.name} was taken over (token {self.token})")
+                    self.lost.set()
+                    return
+            except Exception as exc:
+                # DB unreachable: lease expires unless next renewal succeeds
+                logger.error(f"Failed to renew {self.name} lease: {exc!s}")
+                continue
+            self.expire_on = renewed_on + PERIODIC_LEASE_SECONDS
+
+    def is_held(self, in_database=False) -> bool:
+        """whether lease is held, also checking token in database if requested"""
+        if self.lost.is_set() or time.monotonic() >= self.expire_on:
+            return False
+        if in_database and not PeriodicJobs.holds(self.name, self.token):
+            logger.error(f"{self.name} was taken over (token {self.token})")
+            self.lost.set()
+            return False
+        return True
+
+    def ensure_held(self, in_database=False):
+        if not self.is_held(in_database):
+            raise LeaseLost(f"{self.name} lease lost (token {self.token})")
+
+    def release(self):
+        self.released.set()
+        self.renewer.join()
+
+
+current_lease = None
+
+
+def lease_lost(in_database=False) -> bool:
+    return current_lease is not None and not current_lease.is_held(in_database)
+
+
+def ensure_lease(in_database=False):
+    """stop current job if this runner doesn't hold its lease anymore (fencing)
+
+    Lease is checked locally (renewals), or also in database right before
+    writes another runner must not repeat"""
+    if current_lease is not None:
+        current_lease.ensure_held(in_database)
+
+
+def run_job(name, force=False) -> bool:
+    """run job if due (or forced) and not leased elsewhere, returning whether it ran
+
+    Start, end, duration and error are recorded in `periodic_jobs`"""
+    global current_lease
+    func, interval, max_duration = JOBS[name]
+    token = PeriodicJobs.start(
+        name,
+        interval,
+        owner=RUNNER_ID,
+        lease_duration=PERIODIC_LEASE_SECONDS,
+        force=force,
+    )
+    if token is None:
+        logger.debug(f"Not running {name}: not due or running elsewhere")
+        return False
+
+    logger.info(f"Running {name} (token {token})…")
+    current_lease = JobLease(name, token, max_duration)
+    started_on, error = time.monotonic(), None
+    try:
+        func()
+    except Exception as exc:
+        logger.error(f"{name} failed: {exc!s}")
+        logger.exception(exc)
+        error = str(exc)
+    finally:
+        current_lease.release()
+        current_lease = None
+    duration = time.monotonic() - started_on
+    metrics.PERIODIC_JOB_SECONDS.observe(
+        duration, job=name, result="failed" if error else "succeeded"
+    )
+    if not PeriodicJobs.end(name, token, duration=duration, error=error):
+        logger.warning(f"{name} was taken over, run not recorded")
+    logger.info(f"Ran {name} in {duration:.1f}s{' (failed)' if error else ''}")
+    return True
+
+
+def run_periodic_tasks():
+    """run all due jobs once"""
+    for name in JOBS:
+        if stopping.is_set():
+            break
+        run_job(name)
+
+
+def run_forever():
+    """run due jobs until stopped (SIGTERM/SIGINT), sleeping until next is due"""
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    logger.info(f"Running periodic tasks: {', '.join(JOBS)}")
+    while not stopping.is_set():
+        run_periodic_tasks()
+        next_due_on = min(
+            PeriodicJobs.next_due_on(name, interval)
+            for name, (_, interval, _) in JOBS.items()
+        )
+        sleep = (next_due_on - datetime.datetime.now()).total_seconds()
+        stopping.wait(min(max(sleep, 1), PERIODIC_TASKS_TICK))
+    logger.info("Stopped periodic tasks")
+
+
+def entrypoint():
+    parser = argparse.ArgumentParser(
+        description="Run periodic tasks (due ones once, by default)"
+    )
+    parser.add_argument(
+        "--loop", action="store_true", help="keep running due tasks until stopped"
+    )
+    parser.add_argument(
+        "--job",
+        choices=JOBS.keys(),
+        help="run only this job, now (even if not due)",
+    )
+    args = parser.parse_args()
+
+    if args.job:
+        if not run_job(args.job, force=True):
+            logger.error(f"{args.job} is already running")
+            return 1
+        return 0
+
+    if DISABLE_PERIODIC_TASKS:
+        logger.info("Periodic tasks are disabled (DISABLE_PERIODIC_TASKS)")
+        return 0
+
+    if args.loop:
+        run_forever()
+    else:
         run_periodic_tasks()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(entrypoint())
@@ -1,18 +1,127 @@
 #!/usr/bin/env python
 
+import argparse
+import datetime
 import logging
 import os
 import socket
+import sys
 
+from bson import ObjectId
 from cerberus import Validator
 from emailing import send_email
-from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
 from utils import mongo
 from werkzeug.security import generate_password_hash
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+A_DATE = datetime.datetime(2026, 1, 1)
+AN_ID = ObjectId("000000000000000000000000")
+
+# (collection, query, sort) for every query we expect to hit an index
+QUERY_SHAPES = [
+    (mongo.Users, {"username": "-"}, None),
+    (mongo.Users, {"email": "-"}, None),
+    (mongo.RefreshTokens, {"token": "-"}, None),
+    (
+        mongo.Acknowlegments,
+        {"username": "-", "worker_type": "creator", "slot": "-"},
+        None,
+    ),
+    (mongo.Acknowlegments, {"worker_type": "creator", "on": {"$gte": A_DATE}}, None),
+    (mongo.Channels, {"slug": "-"}, None),
+    (mongo.Warehouses, {"slug": "-"}, None),
+    (mongo.Orders, {"status": mongo.Orders.pending_expiry}, None),
+    (mongo.AutoImages, {"slug": "-"}, None),
+    (mongo.AutoImages, {"status": "building"}, None),
+    (mongo.AutoImages, {"status": "ready"}, None),
+    (
+        mongo.AutoImages,
+        {
+            "$or": [
+                {"status": {"$in": [None, "failed"]}},
+                {"status": "ready", "expire_on": {"$lte": A_DATE}},
+            ]
+        },
+        None,
+    ),
+    (mongo.UploadedFiles, {"download_url": "-"}, None),
+    (mongo.UploadedFiles, {"download_url": {"$in": ["-", "--"]}}, None),
+    (mongo.UploadedFiles, {"status": "pending", "created_on": {"$lte": A_DATE}}, None),
+    (
+        mongo.UploadedFiles,
+        {"status": "confirmed", "expire_on": {"$lt": A_DATE}},
+        None,
+    ),
+    (
+        mongo.UploadedFiles,
+        {
+            "status": "confirmed",
+            "$or": [{"checked_on": {"$lt": A_DATE}}, {"checked_on": None}],
+        },
+        [("checked_on", 1)],
+    ),
+    (
+        mongo.UploadedFiles,
+        {"download_url": {"$in": ["-"]}, "expire_on": {"$ne": None}},
+        [("expire_on", 1)],
+    ),
+    (mongo.TaskLogs, {"task": AN_ID, "kind": "worker"}, [("offset", -1)]),
+    (
+        mongo.TaskLogs,
+        {"task": {"$in": [AN_ID]}},
+        [("task", 1), ("kind", 1), ("offset", 1)],
+    ),
+    (
+        mongo.CreatorTasks,
+        {"status": {"$in": mongo.CreatorTasks.ACTIVE_STATUSES}},
+        [("_id", 1)],
+    ),
+    (
+        mongo.CreatorTasks,
+        {"status": {"$in": mongo.CreatorTasks.CREATOR_SUCCESS_STATUSES}},
+        [("_id", -1)],
+    ),
+    (mongo.Emails, {"status": mongo.Emails.pending}, None),
+    (mongo.StripeCustomer, {"email": "-"}, None),
+    (mongo.StripeSession, {"session_id": "-"}, None),
+]
+for tasks_cls in (mongo.CreatorTasks, mongo.DownloaderTasks, mongo.WriterTasks):
+    QUERY_SHAPES += [
+        (tasks_cls, {"status": tasks_cls.pending}, None),
+        (
+            tasks_cls,
+            {
+                "status": {
+                    "$in": tasks_cls.PENDING_STATUSES + tasks_cls.WORKING_STATUSES
+                }
+            },
+            None,
+        ),
+        (tasks_cls, {"status": {"$in": tasks_cls.IN_PROGRESS_STATUSES}}, None),
+        (
+            tasks_cls,
+            {
+                "status": {"$in": tasks_cls.IN_PROGRESS_STATUSES},
+                "deadline": {"$lt": A_DATE},
+            },
+            None,
+        ),
+    ]
+
+
+def get_plan_stages(plan: dict) -> list:
+    """list of stages names in an explain()'s plan tree (depth-first)"""
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += get_plan_stages(plan[key])
+    for sub_plan in plan.get("inputStages", []):
+        stages += get_plan_stages(sub_plan)
+    return [stage for stage in stages if stage]
+
 
 class Initializer:
     @staticmethod
@@ -21,11 +130,14 @@ class Initializer:
             return
         if os.getenv("TEST_EMAIL"):
             logger.info("send test email to: {}".format(os.getenv("TEST_EMAIL")))
-            send_email(
-                os.getenv("TEST_EMAIL"),
-                "scheduler test",
-                "started a scheduler at {}".format(socket.gethostname()),
-            )
+            try:
+                send_email(
+                    os.getenv("TEST_EMAIL"),
+                    "scheduler test",
+                    "started a scheduler at {}".format(socket.gethostname()),
+                )
+            except Exception as exc:
+                logger.error(f"Unable to send test email: {exc!s}")
         logger.info("Running pre-start initialization...")
         if bool(os.getenv("RESET_DB", False)):
             logger.info("removed {} tokens".format(mongo.RefreshTokens().remove({})))
@@ -40,20 +152,69 @@ class Initializer:
             logger.info(
                 "removed {} writer_tasks".format(mongo.WriterTasks().remove({}))
             )
+            logger.info("removed {} task_logs".format(mongo.TaskLogs().remove({})))
         Initializer.create_database_indexes()
+        Initializer.purge_expired_refresh_tokens()
+        Initializer.set_tasks_deadlines()
         Initializer.create_initial_data()
 
     @staticmethod
     def create_database_indexes():
-        mongo.Users().create_index(
-            [(mongo.Users.username, ASCENDING)], name="username", unique=True
-        )
-        mongo.Users().create_index(
-            [(mongo.Users.email, ASCENDING)], name="email", unique=True
-        )
-        mongo.RefreshTokens().create_index(
-            [("token", ASCENDING)], name="token", unique=True
+        for collection_cls in mongo.Collection.concrete_subclasses():
+            if not collection_cls.indexes:
+                continue
+            try:
+                names = collection_cls().create_indexes(collection_cls.indexes)
+            except OperationFailure as exc:
+                # an existing index with same name but different spec/options
+                logger.error(
+                    f"Unable to create indexes on {collection_cls.collection_name}: "
+                    f"{exc}"
+                )
+            else:
+                logger.info(
+                    f"indexes on {collection_cls.collection_name}: {', '.join(names)}"
+                )
+
+    @staticmethod
+    def purge_expired_refresh_tokens():
+        """expired tokens accumulated before their TTL index existed"""
+        count = (
+            mongo.RefreshTokens()
+            .delete_many({"expire_time": {"$lte": datetime.datetime.now()}})
+            .deleted_count
         )
+        if count:
+            logger.info(f"removed {count} expired refresh tokens")
+
+    @staticmethod
+    def set_tasks_deadlines():
+        """tasks that went in-progress before deadlines were recorded"""
+        for tasks_cls in (mongo.CreatorTasks, mongo.DownloaderTasks, mongo.WriterTasks):
+            count = tasks_cls.set_missing_deadlines()
+            if count:
+                logger.info(f"set deadline on {count} {tasks_cls.collection_name}")
+
+    @staticmethod
+    def check_database_indexes() -> bool:
+        """whether all known query shapes are served by an index (no COLLSCAN)"""
+        succeeded = True
+        for collection_cls, query, sort in QUERY_SHAPES:
+            cursor = collection_cls().find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            stages = get_plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+            if "COLLSCAN" in stages:
+                succeeded = False
+                logger.error(
+                    f"COLLSCAN on {collection_cls.collection_name} for {query}"
+                    f"{f' sorted by {sort}' if sort else ''}"
+                )
+            else:
+                logger.info(
+                    f"{'>'.join(stages)} on {collection_cls.collection_name} for {query}"
+                )
+        return succeeded
 
     @staticmethod
     def create_initial_data():
@@ -148,4 +309,13 @@ class Initializer:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scheduler pre-start initialization")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only check that known queries use an index (exits 1 on COLLSCAN)",
+    )
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if Initializer.check_database_indexes() else 1)
     Initializer.start()
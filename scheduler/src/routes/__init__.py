@@ -1,7 +1,11 @@
+import base64
+import binascii
+import itertools
 from functools import wraps
-from flask import request
+from flask import current_app, jsonify, request, stream_with_context
 from jwt import exceptions as jwt_exceptions
 from bson.objectid import ObjectId, InvalidId
+from pymongo import ASCENDING
 
 from utils.token import AccessToken
 from . import errors
@@ -69,3 +73,101 @@ def ensure_user_matches_role(user, roles):
     if user.get("role") not in roles:
         print(user, user.get("role"), "not in", roles)
         raise errors.NotEnoughPrivilege()
+
+
+def encode_cursor(object_id: ObjectId) -> str:
+    """opaque continuation token for a listing resuming after object_id"""
+    return base64.urlsafe_b64encode(object_id.binary).decode("ASCII").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        raise errors.BadRequest("Invalid cursor")
+
+
+STREAM_BATCH_SIZE = 100
+
+
+def paginate(
+    collection,
+    query: dict,
+    projection: dict = None,
+    direction=ASCENDING,
+    transform=None,
+):
+    """listing response (`meta` and `items`) for a collection sorted on _id
+
+    Pages are either requested via `skip` (offset) or, preferably, via the
+    `cursor` returned in previous page's `meta.next` (keyset on _id).
+    `count` is estimated from collection metadata for unfiltered listings,
+    exact if `count=exact` and omitted (None) if `count=none`.
+
+    Items are streamed from the cursor by batches, passed to `transform`
+    (in-place, on the list of items) before being encoded"""
+    skip = request.args.get("skip", default=0, type=int)
+    limit = request.args.get("limit", default=20, type=int)
+    cursor = request.args.get("cursor")
+    count_mode = request.args.get("count", default="estimated")
+    skip = 0 if skip < 0 else skip
+    limit = 20 if limit <= 0 else limit
+
+    page_query = dict(query)
+    if cursor:
+        page_query["_id"] = {
+            "$gt" if direction == ASCENDING else "$lt": decode_cursor(cursor)
+        }
+    documents = (
+        collection.find(page_query, projection)
+        .sort([("_id", direction)])
+        .skip(skip)
+        .limit(limit)
+        .batch_size(min(limit, STREAM_BATCH_SIZE))
+    )
+
+    if count_mode == "none":
+        count = None
+    elif count_mode == "exact" or query:
+        count = collection.count_documents(query)
+    else:
+        count = collection.estimated_document_count()
+
+    def batches():
+        while batch := list(itertools.islice(documents, STREAM_BATCH_SIZE)):
+            if transform:
+                transform(batch)
+            yield batch
+
+    def meta_for(nb_items: int, last_id: ObjectId):
+        return {
+            "skip": skip,
+            "limit": limit,
+            "count": count,
+            "next": encode_cursor(last_id) if nb_items == limit else None,
+        }
+
+    # pretty-printed (debug) responses are not streamed
+    if current_app.debug:
+        items = list(itertools.chain.from_iterable(batches()))
+        last_id = items[-1]["_id"] if items else None
+        return jsonify({"meta": meta_for(len(items), last_id), "items": items})
+
+    def generate():
+        # same output as jsonify: compact, keys sorted (`items` before `meta`)
+        dumps = current_app.json.dumps
+        separator, nb_items, last_id = "", 0, None
+        yield '{"items":['
+        for batch in batches():
+            yield separator + ",".join(
+                dumps(item, separators=(",", ":")) for item in batch
+            )
+            separator = ","
+            nb_items += len(batch)
+            last_id = batch[-1]["_id"]
+        meta = dumps(meta_for(nb_items, last_id), separators=(",", ":"))
+        yield f'],"meta":{meta}}}\n'
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype=current_app.json.mimetype
+    )
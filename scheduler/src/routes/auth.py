@@ -73,7 +73,7 @@ def token():
     """
     Issue a new set of access and refresh token after validating an old refresh token
     Old refresh token can only be used once and hence is removed from database
-    Unused but expired refresh token is also deleted from database
+    Unused but expired refresh tokens are removed by mongo (TTL index)
     """
 
     # get old refresh token from request header
@@ -116,7 +116,6 @@ def token():
 
     # delete old refresh token from database
     collection.delete_one({"token": bson.Binary.from_uuid(UUID(old_token))})
-    collection.delete_many({"expire_time": {"$lte": datetime.now()}})
 
     # send response
     response_json = {"access_token": access_token, "refresh_token": refresh_token}
@@ -1,12 +1,10 @@
-import pymongo
 from bson import ObjectId
 from flask import Blueprint, Response, jsonify, request
 from flask import redirect as flask_redirect
 from jsonschema import ValidationError, validate
-from utils.files import FileChecker
-from utils.mongo import AutoImages, Users
+from utils.mongo import AutoImages, Configs, UploadedFiles, Users
 
-from routes import authenticate, ensure_user_matches_role, errors
+from routes import authenticate, ensure_user_matches_role, errors, paginate
 
 blueprint = Blueprint("autoimage", __name__, url_prefix="/auto-images")
 
@@ -23,14 +21,9 @@ def collection(user: dict):
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
 
         # unpack url parameters
-        skip = request.args.get("skip", default=0, type=int)
-        limit = request.args.get("limit", default=20, type=int)
         with_config = request.args.get("with_config", default=False, type=bool)
         with_yaml = request.args.get("with_yaml", default=False, type=bool)
-        skip = 0 if skip < 0 else skip
-        limit = 20 if limit <= 0 else limit
 
-        query = {}
         projection = {"config_yaml": 0, "config": 0}
         if with_config and with_yaml:
             projection = None
@@ -38,21 +31,21 @@ def collection(user: dict):
             projection = {"config_yaml": 0}
         elif with_yaml:
             projection = {"config": 0}
-        cursor = (
-            AutoImages()
-            .find(query, projection)
-            .sort([("$natural", pymongo.ASCENDING)])
-            .skip(skip)
-            .limit(limit)
-        )
-        count = AutoImages().count_documents(query)
-        autoimages = [autoimage for autoimage in cursor]
-
-        return jsonify(
-            {
-                "meta": {"skip": skip, "limit": limit, "count": count},
-                "items": autoimages,
-            }
+        fields = [
+            field
+            for field, requested in (
+                ("config", with_config),
+                ("config_yaml", with_yaml),
+            )
+            if requested
+        ]
+        return paginate(
+            AutoImages(),
+            {},
+            projection,
+            transform=(
+                (lambda items: Configs.expand(items, fields=fields)) if fields else None
+            ),
         )
     elif request.method == "POST":
         # check user permission
@@ -67,7 +60,8 @@ def collection(user: dict):
         if AutoImages().count_documents({"slug": request_json["slug"]}):
             raise errors.BadRequest("autoimage with this slug exists.")
 
-        AutoImages().insert_one(request_json)
+        AutoImages().insert_one(Configs.dehydrate(request_json))
+        AutoImages.invalidate(request_json["slug"])
         return jsonify({"slug": request_json["slug"]})
 
 
@@ -81,16 +75,13 @@ def document(autoimage_slug: ObjectId, user: dict):
         # /!\ this returns nothing but the _id
         # seems like an error but it's useful at the moment since that endpoint
         # is called frequently to get autodelete_on so leaving as is.
-        autoimage = AutoImages().find_one({"slug": autoimage_slug}, {})
+        autoimage = AutoImages().find_one({"slug": autoimage_slug}, {"http_urls": 1})
         if autoimage is None:
             raise errors.NotFound()
 
-        autodelete_on = [
-            FileChecker(file).expire_on
-            for file in AutoImages.get_uploaded_files(autoimage_slug)
-        ]
+        autodelete_on = UploadedFiles.earliest_expiry(autoimage.pop("http_urls", []))
         if autodelete_on:
-            autoimage["autodelete_on"] = min(autodelete_on).isoformat()
+            autoimage["autodelete_on"] = autodelete_on.isoformat()
 
         return jsonify(autoimage)
 
@@ -109,7 +100,14 @@ def document(autoimage_slug: ObjectId, user: dict):
         except ValidationError as error:
             raise errors.BadRequest(str(error))
 
-        AutoImages().update_one({"slug": autoimage_slug}, {"$set": request_json})
+        AutoImages().update_one(
+            {"slug": autoimage_slug},
+            {
+                "$set": Configs.dehydrate(request_json),
+                # previous (not migrated) inline values
+                "$unset": {field: "" for field in Configs.FIELDS},
+            },
+        )
         # we blank image status so periodic-tasks will recreate it
         AutoImages.update_status(autoimage_slug, status=None)
         return jsonify({"slug": request_json["slug"]})
@@ -118,47 +116,53 @@ def document(autoimage_slug: ObjectId, user: dict):
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
 
         deleted_count = AutoImages().delete_one({"slug": autoimage_slug}).deleted_count
+        AutoImages.invalidate(autoimage_slug)
         if deleted_count == 0:
             raise errors.NotFound()
 
         return Response()
 
 
-@blueprint.route("/<string:autoimage_slug>/json", methods=["GET"])
-@authenticate(allow_noauth=True)
-def json_document(autoimage_slug: ObjectId, user: dict):
-
-    autoimage = AutoImages().find_one(
-        {"slug": autoimage_slug},
-        {
-            "slug": 1,
-            "private": 1,
-            "http_url": 1,
-            "torrent_url": 1,
-            "http_urls": 1,
-            "torrent_urls": 1,
-            "expire_on": 1,
-            "_id": 0,
-        },
-    )
+def get_json_document(autoimage_slug: str, user: dict):
+    """public document of an autoimage, checking permission if private"""
+    autoimage = AutoImages.get_json(autoimage_slug)
     if autoimage is None:
         raise errors.NotFound()
 
     if autoimage.pop("private", True):
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
+        return autoimage, False
+    return autoimage, True
+
+
+def with_cache_headers(response: Response, public: bool) -> Response:
+    """let reverse-proxies and clients reuse (or revalidate) the response"""
+    if public:
+        response.cache_control.public = True
+        response.cache_control.max_age = AutoImages.json_cache.ttl
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
 
-    return jsonify(autoimage)
+
+@blueprint.route("/<string:autoimage_slug>/json", methods=["GET"])
+@authenticate(allow_noauth=True)
+def json_document(autoimage_slug: str, user: dict):
+    autoimage, public = get_json_document(autoimage_slug, user)
+    return with_cache_headers(jsonify(autoimage), public)
 
 
 @blueprint.route("/<string:autoimage_slug>/redirect/<string:method>", methods=["GET"])
-def redirect(autoimage_slug: ObjectId, method: str):
+@authenticate(allow_noauth=True)
+def redirect(autoimage_slug: str, method: str, user: dict):
     """only for public images (user not forwarded)"""
 
     if method not in ["http", "torrent"]:
         raise errors.NotFound()
 
-    response = json_document(autoimage_slug)
-    if response.status_code != 200:
-        return response
-
-    return flask_redirect(location=response.get_json()[f"{method}_url"], code=302)
+    autoimage, public = get_json_document(autoimage_slug, user)
+    return with_cache_headers(
+        flask_redirect(location=autoimage[f"{method}_url"], code=302), public
+    )
@@ -61,6 +61,7 @@ def collection(user: dict):
             raise errors.BadRequest("Channel with this slug exists.")
 
         channel_id = Channels().insert_one(request_json).inserted_id
+        Channels.invalidate()
         return jsonify({"_id": channel_id})
 
 
@@ -83,6 +84,7 @@ def document(channel_id: ObjectId, user: dict):
         deleted_count = Channels().delete_one({"_id": channel_id}).deleted_count
         if deleted_count == 0:
             raise errors.NotFound()
+        Channels.invalidate()
 
         return Response()
 
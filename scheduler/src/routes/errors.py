@@ -8,6 +8,7 @@ def register_handlers(app: Flask):
     app.errorhandler(BadRequest)(BadRequest.handler)
     app.errorhandler(Unauthorized)(Unauthorized.handler)
     app.errorhandler(NotFound)(NotFound.handler)
+    app.errorhandler(Conflict)(Conflict.handler)
     app.errorhandler(InternalError)(InternalError.handler)
 
     @app.errorhandler(jwt_exceptions.ExpiredSignatureError)
@@ -91,6 +92,21 @@ class NotFound(Exception):
             return Response(status=404)
 
 
+# 409
+class Conflict(Exception):
+    def __init__(self, message: str = None):
+        self.message = message
+
+    @staticmethod
+    def handler(e):
+        if isinstance(e, Conflict) and e.message is not None:
+            response = jsonify({"error": e.message})
+            response.status_code = 409
+            return response
+        else:
+            return Response(status=409)
+
+
 # 500
 class InternalError(Exception):
     @staticmethod
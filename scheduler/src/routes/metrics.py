@@ -0,0 +1,84 @@
+import hmac
+import os
+import time
+
+from flask import Blueprint, Flask, Response, g, request
+from utils import metrics
+from utils.cache import MISSING, TTLCache
+from utils.mongo import (
+    CreatorTasks,
+    DownloaderTasks,
+    Emails,
+    Metrics,
+    PeriodicJobs,
+    WriterTasks,
+)
+
+from routes import errors
+
+# bearer token required to read metrics (public if not set)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or ""
+# rendered metrics are reused (per process) for
+METRICS_CACHE_SECONDS = int(os.getenv("METRICS_CACHE_SECONDS") or 15)
+
+blueprint = Blueprint("metrics", __name__, url_prefix="/metrics")
+rendered_cache = TTLCache(METRICS_CACHE_SECONDS, maxsize=1)
+
+
+def register_handlers(app: Flask):
+    """time every request (cardshop_http_request_duration_seconds)"""
+
+    @app.before_request
+    def start_timer():
+        g.started_on = time.perf_counter()
+
+    @app.after_request
+    def record_duration(response):
+        if "started_on" in g:
+            metrics.HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - g.started_on,
+                method=request.method,
+                route=request.url_rule.rule if request.url_rule else "unmatched",
+                status=response.status_code,
+            )
+        return response
+
+
+def get_values():
+    """stored counters and histograms along with gauges from indexed counts"""
+    # so this process' latest changes are included
+    metrics.REGISTRY.flush()
+    values = Metrics.all_values()
+
+    tasks = values.setdefault(metrics.TASKS.name, {})
+    for tasks_cls in (CreatorTasks, DownloaderTasks, WriterTasks):
+        counts = tasks_cls.count_by_channel_and_status()
+        for (channel, status), count in counts.items():
+            labels = (
+                ("type", tasks_cls.task_type()),
+                ("channel", channel or ""),
+                ("status", status),
+            )
+            tasks[labels] = count
+
+    values[metrics.EMAILS_QUEUED.name] = {(): Emails.count_queued()}
+    values[metrics.PERIODIC_JOB_LAST_DURATION.name] = {
+        (("job", name),): duration
+        for name, duration in PeriodicJobs.last_durations().items()
+    }
+    return values
+
+
+@blueprint.route("", methods=["GET"])
+def collection():
+    """Prometheus text exposition of scheduler metrics (cached briefly)"""
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        raise errors.Unauthorized()
+
+    text = rendered_cache.get("metrics", MISSING)
+    if text is MISSING:
+        text = metrics.render(get_values())
+        rendered_cache.set("metrics", text)
+    return Response(text, mimetype="text/plain; version=0.0.4")
@@ -4,6 +4,7 @@ import os
 import pymongo
 from bson import ObjectId
 from emailing import (
+    queue_email,
     send_order_created_email,
     send_order_failed_email,
     send_order_shipped_email,
@@ -11,9 +12,9 @@ from emailing import (
 from flask import Blueprint, render_template, request, jsonify
 from jsonschema import ValidationError, validate
 from utils.json import ensure_objectid
-from utils.mongo import Orders, Users
+from utils.mongo import Configs, Orders, Users
 
-from routes import authenticate, bson_object_id, errors, only_for_roles
+from routes import authenticate, bson_object_id, errors, only_for_roles, paginate
 
 blueprint = Blueprint("order", __name__, url_prefix="/orders")
 
@@ -48,8 +49,8 @@ def create_order_from(payload):
         {"status": Orders().created, "on": datetime.datetime.now(), "payload": None}
     ]
 
-    # actually create Order
-    order_id = Orders().insert_one(payload).inserted_id
+    # actually create Order (referencing its config)
+    order_id = Orders().insert_one(Configs.dehydrate(payload)).inserted_id
 
     # define and record fname for this order
     if "fname" not in payload:
@@ -64,7 +65,7 @@ def create_order_from(payload):
     Orders.update(order_id, {"fname": fname})
 
     # send email about new order
-    send_order_created_email(order_id)
+    queue_email(send_order_created_email, order_id)
 
     # create creation task
     Orders.create_creator_task(order_id)
@@ -81,26 +82,15 @@ def collection(user: dict):
     """
 
     if request.method == "GET":
-        # unpack url parameters
-        skip = request.args.get("skip", default=0, type=int)
-        limit = request.args.get("limit", default=20, type=int)
-        skip = 0 if skip < 0 else skip
-        limit = 20 if limit <= 0 else limit
-
-        query = {}
-        projection = {"_id": 1}
-        cursor = (
-            Orders()
-            .find(query, projection)
-            .sort([("$natural", pymongo.DESCENDING)])
-            .skip(skip)
-            .limit(limit)
-        )
-        count = Orders().count_documents(query)
-        orders = [Orders.get(order.get("_id")) for order in cursor]
-
-        return jsonify(
-            {"meta": {"skip": skip, "limit": limit, "count": count}, "items": orders}
+        # newest first
+        return paginate(
+            Orders(),
+            {},
+            Orders.projection_for("summary"),
+            direction=pymongo.DESCENDING,
+            transform=lambda items: Configs.expand(
+                items, fields=("config",), config_fields=["name"]
+            ),
         )
     if request.method == "POST":
         try:
@@ -140,10 +130,18 @@ def document(order_id: ObjectId, user: dict):
     """fetch indiviual order info or cancel it"""
     if request.method == "GET":
         with_logs = request.args.get("with_logs", default=False, type=string_to_bool)
-        order = Orders.get_with_tasks(order_id, with_logs=with_logs)
+        try:
+            order = Orders.get_with_tasks(
+                order_id,
+                with_logs=with_logs,
+                fields=request.args.get("fields", default="full"),
+            )
+        except ValueError as exc:
+            raise errors.BadRequest(str(exc))
         if order is None:
             raise errors.NotFound()
 
+        Configs.expand([order, order["tasks"]["create"]])
         return jsonify(order)
 
     if request.method == "PATCH":
@@ -152,9 +150,10 @@ def document(order_id: ObjectId, user: dict):
             raise errors.NotFound()
 
         request_json = request.get_json()
-        Orders().add_shipment(order_id, request_json.get("shipment_details"))
+        now = datetime.datetime.now()
+        Orders().add_shipment(order_id, request_json.get("shipment_details"), on=now)
 
-        send_order_shipped_email(order_id)
+        queue_email(send_order_shipped_email, order_id, on=now)
 
         return jsonify(order)
 
@@ -174,12 +173,12 @@ def document(order_id: ObjectId, user: dict):
 @only_for_roles(roles=Users.MANAGER_ROLE)
 @bson_object_id(["order_id"])
 def cancel(order_id: ObjectId, user: dict):
-    order = Orders.get(order_id)
-    if order is None:
+    if not Orders().count_documents({"_id": order_id}, limit=1):
         raise errors.NotFound()
 
-    Orders().cancel(order_id)
-    send_order_failed_email(order_id)
+    now = datetime.datetime.now()
+    Orders().cancel(order_id, on=now)
+    queue_email(send_order_failed_email, order_id, on=now)
 
     return jsonify({"_id": order_id})
 
@@ -189,7 +188,10 @@ def cancel(order_id: ObjectId, user: dict):
 # @only_for_roles(roles=Users.WORKER_ROLES)
 @bson_object_id(["order_id"])
 def add_shipment(order_id: ObjectId):
-    order = Orders().find_one({"_id": order_id, "status": Orders.pending_shipment})
+    order = Orders().find_one(
+        {"_id": order_id, "status": Orders.pending_shipment},
+        Orders.projection_for("summary"),
+    )
     if order is None:
         raise errors.NotFound()
 
@@ -203,11 +205,12 @@ def add_shipment(order_id: ObjectId):
             raise errors.BadRequest("Missing shipment details")
 
         # store shipment details
-        Orders().add_shipment(order_id, shipment_details)
+        now = datetime.datetime.now()
+        Orders().add_shipment(order_id, shipment_details, on=now)
         # refresh order object
-        order = Orders.get(order_id)
+        order = Orders.get(order_id, fields="summary")
         # send recipient an email
-        send_order_shipped_email(order_id)
+        queue_email(send_order_shipped_email, order_id, on=now)
 
         return render_template(
             "pub_thank_shipment.html", order=order, order_id=order["_id"]
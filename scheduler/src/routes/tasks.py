@@ -2,6 +2,7 @@ import datetime
 
 from bson import ObjectId
 from emailing import (
+    queue_email,
     send_image_uploaded_email,
     send_image_uploaded_public_email,
     send_image_writing_email,
@@ -11,11 +12,14 @@ from emailing import (
     send_order_pending_shipment_email,
 )
 from flask import Blueprint, jsonify, render_template, request
+from utils import metrics
 from utils.mongo import (
     Acknowlegments,
+    Configs,
     CreatorTasks,
     DownloaderTasks,
     Orders,
+    TaskLogs,
     Tasks,
     UploadedFiles,
     Users,
@@ -52,7 +56,18 @@ def typed_collection(task_type: str, user: dict):
             worker_type=task_type,
             slot=request.args.get("slot"),
         )
-        tasks = tasks_cls_for(task_type).find_availables(channel=user.get("channel"))
+        fields = request.args.get("fields", default="full")
+        try:
+            tasks = tasks_cls_for(task_type).find_availables(
+                channel=user.get("channel"),
+                worker=user["username"],
+                fields=fields,
+                limit=request.args.get("limit", default=None, type=int),
+            )
+        except ValueError as exc:
+            raise errors.BadRequest(str(exc))
+        if fields == "full":
+            Configs.expand(tasks)
 
         return jsonify(tasks)
 
@@ -64,10 +79,16 @@ def typed_collection(task_type: str, user: dict):
 def document(task_id: ObjectId, task_type: str, user: dict):
     """fetch indiviual yask info or cancel it"""
     if request.method == "GET":
-        task = tasks_cls_for(task_type).get(task_id)
+        try:
+            task = tasks_cls_for(task_type).get(
+                task_id, fields=request.args.get("fields", default="full")
+            )
+        except ValueError as exc:
+            raise errors.BadRequest(str(exc))
         if task is None:
             raise errors.NotFound()
 
+        Configs.expand([task])
         return jsonify(task)
 
     elif request.method == "DELETE":
@@ -76,6 +97,7 @@ def document(task_id: ObjectId, task_type: str, user: dict):
         deleted_count = task_cls().delete_one({"_id": task_id}).deleted_count
         if deleted_count == 0:
             raise errors.NotFound()
+        TaskLogs.delete_for(task_id)
 
         # send email about deletion
 
@@ -88,11 +110,11 @@ def document(task_id: ObjectId, task_type: str, user: dict):
 @bson_object_id(["task_id"])
 def register_task(task_id: ObjectId, task_type: str, user: dict):
     task_cls = tasks_cls_for(task_type)
-    task = task_cls().find({"_id": task_id, "status": task_cls.pending})
+    task = task_cls.register(task_id, user)
     if task is None:
-        raise errors.NotFound()
-
-    task_cls.register(task_id, user)
+        if not task_cls().count_documents({"_id": task_id}, limit=1):
+            raise errors.NotFound()
+        raise errors.Conflict("Task is not available anymore")
 
     # update ACK
     Acknowlegments.busy_update(
@@ -102,7 +124,36 @@ def register_task(task_id: ObjectId, task_type: str, user: dict):
         task_id=task_id,
     )
 
-    return jsonify({"_id": task_id})
+    # full task (polling only returns summaries)
+    Configs.expand([task])
+    return jsonify(task)
+
+
+@blueprint.route("/<string:task_type>/request_next", methods=["PATCH"])
+@authenticate()
+@only_for_roles(roles=Users.WORKER_ROLES)
+def register_next_task(task_type: str, user: dict):
+    """claim next available task without listing first"""
+    task_cls = tasks_cls_for(task_type)
+    task = task_cls.register_next(user)
+    if task is None:
+        Acknowlegments.idle_update(
+            username=user["username"],
+            worker_type=task_type,
+            slot=request.args.get("slot"),
+        )
+        raise errors.NotFound("No available task")
+
+    # update ACK
+    Acknowlegments.busy_update(
+        username=user["username"],
+        worker_type=task_type,
+        slot=request.args.get("slot"),
+        task_id=task["_id"],
+    )
+
+    Configs.expand([task])
+    return jsonify(task)
 
 
 @blueprint.route(
@@ -116,14 +167,14 @@ def confirm_inserted_task(task_id: ObjectId, task_type: str):
         raise errors.NotFound()
 
     if request.method == "GET":
-        order = Orders().get(task["order"])
+        order = Orders().get(task["order"], fields="status")
         return render_template("pub_confirm_inserted.html", order=order, task=task)
 
     elif request.method == "POST":
-        task_cls.update_status(task_id, status=task_cls.card_inserted)
-        task_cls.cascade_status(task_id, task_cls.card_inserted)
+        if task_cls.update_status(task_id, status=task_cls.card_inserted):
+            task_cls.cascade_status(task_id, task_cls.card_inserted)
 
-        order = Orders().get(task["order"])
+        order = Orders().get(task["order"], fields="status")
 
         return render_template("pub_thank_inserted.html", order=order, task=task)
     raise errors.BadRequest("?")
@@ -135,7 +186,7 @@ def confirm_inserted_task(task_id: ObjectId, task_type: str):
 @bson_object_id(["task_id"])
 def update_status(task_id: ObjectId, task_type: str, user: dict):
     task_cls = tasks_cls_for(task_type)
-    task = task_cls().get(task_id)
+    task = task_cls().get(task_id, fields="status")
     if task is None:
         raise errors.NotFound()
 
@@ -150,12 +201,21 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
     extras = request_json.get("extra", {})
     urls = extras.pop("urls", [])
     status = request_json.get("status")
-    task_cls.update_status(
+    # when task entered status (scopes emails to this transition)
+    now = datetime.datetime.now()
+    if not task_cls.update_status(
         task_id,
         status=request_json.get("status"),
         payload=request_json.get("log"),
         extra_update=extras,
-    )
+        expected_size=task_cls.expected_size_of(task),
+        on=now,
+    ):
+        # repeated update (worker retrying): already done, side effects included
+        current = task_cls.get(task_id, fields="status")
+        if current and current["status"] == status:
+            return jsonify({"_id": task_id})
+        raise errors.Conflict(f"Task cannot transition to {status}")
 
     # update order status based on this task
     task_cls.cascade_status(task_id, request_json.get("status"))
@@ -183,7 +243,7 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
             print(f"Created UploadedFile {uf['_id']} for torrent")
     # create task uploaded image
     elif status == Tasks.uploaded_public:
-        order = Orders().get(order_id)
+        order = Orders().get(order_id, fields="status")
         # set expiration date
         expiration = datetime.datetime.now() + datetime.timedelta(
             days=order["sd_card"]["duration"]
@@ -197,8 +257,11 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
                 ],
             },
         )
-        send_image_uploaded_public_email(order_id)
-        now = datetime.datetime.now()
+        queue_email(send_image_uploaded_public_email, order_id, on=now)
+        # creator sets markers to expire after that many days (at least 2)
+        files_expire_on = now + datetime.timedelta(
+            days=max([2, int(order["sd_card"]["duration"])])
+        )
         for url in urls:
             upload_url = url.get("upload", "")
             download_url = url.get("download", "")
@@ -207,15 +270,25 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
             uf = UploadedFiles.get_or_create(
                 upload_url=upload_url, download_url=download_url
             )
-            UploadedFiles.update(uf["_id"], status="confirmed", confirmed_on=now)
+            UploadedFiles.update(
+                uf["_id"],
+                status="confirmed",
+                confirmed_on=now,
+                expire_on=files_expire_on,
+            )
             # confirm torrent file as well
             uf = UploadedFiles.get_or_create(
                 upload_url=upload_url, download_url=f"{download_url}.torrent"
             )
-            UploadedFiles.update(uf["_id"], status="confirmed", confirmed_on=now)
+            UploadedFiles.update(
+                uf["_id"],
+                status="confirmed",
+                confirmed_on=now,
+                expire_on=files_expire_on,
+            )
 
     elif status == Tasks.uploaded:
-        send_image_uploaded_email(order_id)
+        queue_email(send_image_uploaded_email, order_id, on=now)
 
         # create DownloadTask
         Orders().create_downloader_task(
@@ -235,31 +308,31 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
     # write task was registered
     elif status == Tasks.waiting_for_card:
         # send email to insert card
-        send_insert_card_email(order_id, task_id)
+        queue_email(send_insert_card_email, order_id, task_id, on=now)
 
     # write task started writing
     elif status == Tasks.writing:
-        send_image_writing_email(order_id, task_id)
+        queue_email(send_image_writing_email, order_id, task_id, on=now)
 
     # write task completed
     elif status == Tasks.written:
-        send_image_written_email(order_id, task_id)
-
-        order = Orders().get_with_tasks(order_id)
-        # all write tasks are marked as written
-        if not [1 for wt in order["tasks"]["write"] if wt["status"] != Tasks.written]:
-            Orders().update_status(order_id, Orders.pending_shipment)
+        queue_email(send_image_written_email, order_id, task_id, on=now)
 
-            send_order_pending_shipment_email(order_id)
+        order = Orders().get_with_tasks(order_id, fields="status")
+        # all write tasks are marked as written (once: writers may end together)
+        if not [
+            1 for wt in order["tasks"]["write"] if wt["status"] != Tasks.written
+        ] and Orders().update_status(order_id, Orders.pending_shipment, on=now):
+            queue_email(send_order_pending_shipment_email, order_id, on=now)
 
             # find matching download task and mark it for file removal
             DownloaderTasks().update_status(
-                task_id=order["tasks"]["download"],
+                task_id=order["tasks"]["download"]["_id"],
                 status=Tasks.pending_image_removal,
             )
 
     elif status in Tasks.FAILED_STATUSES:
-        send_order_failed_email(order_id)
+        queue_email(send_order_failed_email, order_id, on=now)
 
     return jsonify({"_id": task_id})
 
@@ -276,7 +349,8 @@ def add_log(task_id: ObjectId, task_type: str, user: dict):
 
     request_json = request.get_json()
 
-    task_cls.update_logs(
+    # logs are appended ; each starting at its `offsets` entry (default 0)
+    sizes = task_cls.update_logs(
         task_id,
         worker_log=request_json.get("worker_log"),
         installer_log=request_json.get("installer_log"),
@@ -284,7 +358,14 @@ def add_log(task_id: ObjectId, task_type: str, user: dict):
         downloader_log=request_json.get("downloader_log"),
         wipe_log=request_json.get("wipe_log"),
         writer_log=request_json.get("writer_log"),
+        offsets=request_json.get("offsets"),
     )
+    for kind in sizes:
+        metrics.TASK_LOGS_RECEIVED_BYTES.inc(
+            len(request_json[f"{kind}_log"].encode("utf-8")),
+            type=task_type,
+            kind=kind,
+        )
 
     # update ACK
     Acknowlegments.busy_update(
@@ -294,4 +375,5 @@ def add_log(task_id: ObjectId, task_type: str, user: dict):
         task_id=task_id,
     )
 
-    return jsonify({"_id": task_id})
+    # stored sizes let workers resume from there (or resend after a gap)
+    return jsonify({"_id": task_id, "sizes": sizes})
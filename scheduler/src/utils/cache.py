@@ -0,0 +1,53 @@
+import threading
+import time
+
+MISSING = object()
+
+
+class TTLCache:
+    """thread-safe in-process mapping whose entries expire after `ttl` seconds
+
+    Each process (uwsgi worker, periodic tasks) has its own: invalidating an
+    entry only affects current process, others see changes once it expired"""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expire_on, value = entry
+            if expire_on <= time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.maxsize:
+                self._purge()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _purge(self):
+        """drop expired entries, then oldest ones if still full"""
+        now = time.monotonic()
+        self._entries = {
+            key: entry for key, entry in self._entries.items() if entry[0] > now
+        }
+        while len(self._entries) >= self.maxsize:
+            del self._entries[next(iter(self._entries))]
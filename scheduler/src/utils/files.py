@@ -1,6 +1,10 @@
+import collections
+import concurrent.futures
 import datetime
 import logging
 import os
+import threading
+import time
 from http import HTTPStatus
 from pathlib import Path
 from urllib.parse import SplitResult, parse_qs, urlencode, urlparse
@@ -19,6 +23,9 @@ SSH_KEY_PATH = Path(os.getenv("PRIVATE_SSH_KEY_PATH", "/etc/ssh/uploader.key")).
 # S3 credentials used to delete files from warehouse (or update wasabi autodelete)
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY") or ""
 S3_SECRET_KEY = os.getenv("S3_SECRET_KEY") or ""
+# files checked (HTTP) or updated (upload) concurrently, overall and per host
+FILES_CHECK_WORKERS = int(os.getenv("FILES_CHECK_WORKERS") or 8)
+FILES_CHECK_PER_HOST = int(os.getenv("FILES_CHECK_PER_HOST") or 4)
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -38,6 +45,60 @@ def get_credentials_s3_url(s3_url: str) -> str:
     ).geturl()
 
 
+def get_session() -> requests.Session:
+    """keep-alive session with a connection pool sized for concurrent checks"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=FILES_CHECK_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slot(url: str) -> threading.BoundedSemaphore:
+    """semaphore limiting concurrent requests to url's host"""
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(FILES_CHECK_PER_HOST)
+        return _host_slots[host]
+
+
+def process_files(files, func, label: str, stop=None) -> collections.Counter:
+    """run func(file) on a thread pool, returning counts of its outcomes
+
+    func returns a short outcome (`extended`, `removed`…) ; exceptions are
+    logged and counted as `failed`. Files not started yet once `stop()`
+    returns True are `skipped`. Logs a summary with duration."""
+
+    def run(file):
+        if stop and stop():
+            return "skipped"
+        return func(file)
+
+    started_on = time.monotonic()
+    outcomes = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(FILES_CHECK_WORKERS) as executor:
+        futures = {executor.submit(run, file): file for file in files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                outcomes[future.result()] += 1
+            except Exception as exc:
+                file = futures[future]
+                logger.error(f"Failed to process {file['_id']},{file['download_url']}")
+                logger.exception(exc)
+                outcomes["failed"] += 1
+    logger.info(
+        f"{label}: {sum(outcomes.values())} files in "
+        f"{time.monotonic() - started_on:.1f}s "
+        f"({', '.join(f'{outcome}={nb}' for outcome, nb in outcomes.items())})"
+    )
+    return outcomes
+
+
 class MarkerNotFound(Exception): ...
 
 
@@ -49,18 +110,18 @@ class FileChecker:
     extend_before_days: int = AUTO_IMAGES_EXTEND_BEFORE_DAYS
     extend_for_days: int = AUTO_IMAGES_EXTEND_FOR_DAYS
     marker_suffix: str = ".delete_on"
+    session: requests.Session = get_session()
 
     def __init__(self, file: dict):
         self.file = file
 
     def _file_exists(self, fname_suffix: str) -> bool:
         """whether the file (or marker using correct suffix) exists (HTTP check)"""
-        resp = requests.get(
-            f"{self.file['download_url']}{fname_suffix}",
-            allow_redirects=True,
-            timeout=self.http_timeout,
-            stream=True,
-        )
+        url = f"{self.file['download_url']}{fname_suffix}"
+        with host_slot(url):
+            resp = self.session.head(
+                url, allow_redirects=True, timeout=self.http_timeout
+            )
         if resp.status_code == HTTPStatus.NOT_FOUND:
             return False
         resp.raise_for_status()
@@ -92,8 +153,15 @@ class FileChecker:
 
     @property
     def expire_on(self) -> datetime.datetime:
+        """expiration date, as recorded in DB or from marker file if unknown"""
         if not hasattr(self, "_expire_on"):
-            self._expire_on = self.get_expiry()
+            expire_on = self.file.get("expire_on")
+            if expire_on is None:
+                expire_on = self.get_expiry()
+                UploadedFiles.set_expire_on(
+                    self.file["_id"], expire_on, checked_on=datetime.datetime.now()
+                )
+            self._expire_on = expire_on
         return self._expire_on
 
     @expire_on.setter
@@ -128,14 +196,38 @@ class FileChecker:
             else self.file["upload_url"]
         )
 
-        return (
-            set_marker_retrying(
+        expire_on = datetime.datetime.now() + datetime.timedelta(days=days_from_now)
+        with host_slot(upload_url):
+            returncode = set_marker_retrying(
                 upload_url=upload_url,
                 private_key=SSH_KEY_PATH,
                 delete_after=days_from_now,
             )
-            == 0
-        )
+        if returncode != 0:
+            return False
+        UploadedFiles.set_expire_on(self.file["_id"], expire_on)
+        return True
+
+    def reconcile(self) -> bool:
+        """record expiration date from marker file (past if missing or invalid)
+
+        Returns whether storage could be checked"""
+        now = datetime.datetime.now()
+        try:
+            self.expire_on = self.get_expiry()
+        except (MarkerNotFound, InvalidExpirationDate):
+            # set in past so considered expired
+            self.expire_on = now - datetime.timedelta(
+                days=self.extend_before_days, minutes=1
+            )
+        except Exception as exc:
+            # network error? log
+            logger.error(
+                f"Failed to check {self.file['_id']},{self.file['download_url']}: {exc!s}"
+            )
+            return False
+        UploadedFiles.set_expire_on(self.file["_id"], self.expire_on, checked_on=now)
+        return True
 
     def remove_if_expired(self) -> bool:
         """remove file both from storage and DB is it expired"""
@@ -172,26 +264,28 @@ class FileChecker:
             if self.file["upload_url"].startswith("s3")
             else self.file["upload_url"]
         )
-        if file_exists:
-            # remove file
-            remove_file_retrying(upload_url=upload_url, private_key=SSH_KEY_PATH)
-
-        if marker_exists:
-            # remove expiration marker file
-            remove_file_retrying(
-                upload_url=f"{upload_url}{self.marker_suffix}", private_key=SSH_KEY_PATH
-            )
+        with host_slot(upload_url):
+            if file_exists:
+                # remove file
+                remove_file_retrying(upload_url=upload_url, private_key=SSH_KEY_PATH)
+
+            if marker_exists:
+                # remove expiration marker file
+                remove_file_retrying(
+                    upload_url=f"{upload_url}{self.marker_suffix}",
+                    private_key=SSH_KEY_PATH,
+                )
 
     def remove_db_entry(self):
         return UploadedFiles().delete_one({"_id": self.file["_id"]}).deleted_count
 
     def get_expiry(self) -> datetime.datetime:
         """expiration date as specified in marker file (fetch via HTTP)"""
-        resp = requests.get(
-            f"{self.file['download_url']}{self.marker_suffix}",
-            allow_redirects=True,
-            timeout=self.http_timeout,
-        )
+        url = f"{self.file['download_url']}{self.marker_suffix}"
+        with host_slot(url):
+            resp = self.session.get(
+                url, allow_redirects=True, timeout=self.http_timeout
+            )
         if resp.status_code == HTTPStatus.NOT_FOUND:
             raise MarkerNotFound()
 
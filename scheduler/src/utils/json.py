@@ -4,8 +4,40 @@ from uuid import UUID
 from bson.objectid import ObjectId
 from flask.json.provider import DefaultJSONProvider
 
+try:
+    import orjson
+except ImportError:
+    # we don't NEED orjson but it's faster so use it if avail.
+    orjson = None
+
+COMPACT_SEPARATORS = (",", ":")
+
+
+def contains_float(obj) -> bool:
+    """whether a float is found in obj's dicts, lists and tuples (any depth)"""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, float):
+            return True
+        if isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return False
+
 
 class SchedulerJSONProvider(DefaultJSONProvider):
+    """JSON provider serializing datetime, UUID and ObjectId
+
+    Compact dumps (API responses) are encoded with orjson when available.
+    Output is the same as json's: anything orjson can't encode identically
+    (floats, non-ASCII, DEL, large ints, non-str keys…) falls back to it."""
+
+    ORJSON_OPTIONS = (
+        orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else None
+    )
+
     @staticmethod
     def default(o):
         if isinstance(o, datetime):
@@ -16,6 +48,33 @@ class SchedulerJSONProvider(DefaultJSONProvider):
             return str(o)
         return DefaultJSONProvider.default(o)
 
+    def dumps(self, obj, **kwargs) -> str:
+        if (
+            orjson is not None
+            and kwargs == {"separators": COMPACT_SEPARATORS}
+            and self.sort_keys
+            and self.ensure_ascii
+        ):
+            data = self.fast_dumps(obj)
+            if data is not None:
+                return data.decode("ASCII")
+        return super().dumps(obj, **kwargs)
+
+    def fast_dumps(self, obj) -> bytes:
+        """compact json bytes via orjson or None if it would differ from json
+
+        floats are formatted differently (exponents, NaN/Infinity as null)
+        and DEL is not escaped"""
+        if contains_float(obj):
+            return None
+        try:
+            data = orjson.dumps(obj, default=self.default, option=self.ORJSON_OPTIONS)
+        except TypeError:
+            return None
+        if not data.isascii() or b"\x7f" in data:
+            return None
+        return data
+
 
 def ensure_objectid(object_id):
     if not isinstance(object_id, ObjectId):
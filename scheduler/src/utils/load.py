@@ -0,0 +1,201 @@
+import datetime
+import heapq
+import os
+import statistics
+
+from utils.cache import MISSING, TTLCache
+from utils.mongo import Acknowlegments, CreatorTasks, Tasks
+
+ONE_GIB = 2**30
+# number of (most recent) completed creator tasks durations are learned from
+LOAD_HISTORY_SIZE = int(os.getenv("LOAD_HISTORY_SIZE") or 200)
+# durations are learned again after
+LOAD_RATES_CACHE_SECONDS = int(os.getenv("LOAD_RATES_CACHE_SECONDS") or 3600)
+# completed tasks required for a phase's durations to be learned
+LOAD_MIN_SAMPLES = 10
+# creators which acked since are considered connected
+CONNECTED_SECONDS = 900
+BOUNDS = ("low", "median", "high")
+
+# phases of a creator task: statuses it starts and ends with, and whether its
+# duration is proportional to image size (then in seconds per GiB)
+PHASES = {
+    "setup": ([Tasks.received], [Tasks.building], False),
+    "building": ([Tasks.building], [Tasks.built], True),
+    "uploading": ([Tasks.built], Tasks.CREATOR_SUCCESS_STATUSES, True),
+}
+# phases left to a task in status (first one is in progress)
+REMAINING_PHASES = {
+    Tasks.pending: ["setup", "building", "uploading"],
+    Tasks.received: ["setup", "building", "uploading"],
+    Tasks.building: ["building", "uploading"],
+    Tasks.built: ["uploading"],
+    Tasks.uploading: ["uploading"],
+}
+# used until there's enough history: previous fixed estimate (1.875mn per GiB)
+DEFAULT_SECONDS = {"setup": 600, "building": 60, "uploading": 52.5}
+
+rates_cache = TTLCache(LOAD_RATES_CACHE_SECONDS, maxsize=1)
+
+
+def get_size_gib(task):
+    """size (GiB) of task's image, from its order's units if unknown"""
+    size = (task.get("image") or {}).get("size") or Tasks.expected_size_of(task)
+    if size:
+        return size / ONE_GIB
+    units = task.get("units") or 0
+    # physical card units are 10 times download ones but creator impact is identical
+    return units / 10 if units > 512 else units
+
+
+def get_phases_durations(task):
+    """seconds (per GiB for sized phases) task spent in each phase it completed"""
+    on = {event["status"]: event["on"] for event in task.get("statuses", [])}
+    gib = get_size_gib(task)
+    durations = {}
+    for phase, (starts, ends, per_gib) in PHASES.items():
+        start = next((on[status] for status in starts if status in on), None)
+        end = next((on[status] for status in ends if status in on), None)
+        if start is None or end is None or end < start:
+            continue
+        # fixed costs dominate small images: not representative per GiB
+        if per_gib and gib < 1:
+            continue
+        seconds = (end - start).total_seconds()
+        durations[phase] = seconds / gib if per_gib else seconds
+    return durations
+
+
+def learn_rates(tasks):
+    """low (1st decile), median and high (9th decile) durations of each phase
+
+    Phases without LOAD_MIN_SAMPLES completed tasks use DEFAULT_SECONDS"""
+    samples = {phase: [] for phase in PHASES}
+    for task in tasks:
+        for phase, seconds in get_phases_durations(task).items():
+            samples[phase].append(seconds)
+
+    rates = {}
+    for phase, values in samples.items():
+        if len(values) < LOAD_MIN_SAMPLES:
+            rates[phase] = dict.fromkeys(BOUNDS, DEFAULT_SECONDS[phase])
+        else:
+            deciles = statistics.quantiles(values, n=10)
+            rates[phase] = {
+                "low": deciles[0],
+                "median": statistics.median(values),
+                "high": deciles[-1],
+            }
+        rates[phase]["samples"] = len(values)
+        rates[phase]["per_gib"] = PHASES[phase][2]
+    return rates
+
+
+def get_rates():
+    """phases durations learned from recently completed tasks (cached)"""
+    rates = rates_cache.get("rates", MISSING)
+    if rates is MISSING:
+        rates = learn_rates(CreatorTasks.all_recently_completed(LOAD_HISTORY_SIZE))
+        rates_cache.set("rates", rates)
+    return rates
+
+
+def get_remaining_seconds(task, rates, bound, now):
+    """estimated seconds until active task completes, once started"""
+    elapsed = 0
+    if task["status"] != Tasks.pending and task.get("since"):
+        elapsed = (now - task["since"]).total_seconds()
+    gib = get_size_gib(task)
+    remaining = 0
+    for index, phase in enumerate(REMAINING_PHASES[task["status"]]):
+        seconds = rates[phase][bound] * (gib if rates[phase]["per_gib"] else 1)
+        # a late task is expected to complete shortly
+        remaining += max(seconds - elapsed, 0) if index == 0 else seconds
+    return remaining
+
+
+def schedule(tasks, nb_workers, rates, bound, now):
+    """seconds until each task completes (None if no worker to run it)
+
+    Ongoing tasks complete on their worker. Pending ones (oldest first) are
+    started by the first worker to be available"""
+    completions = []
+    workers = []
+    for task in tasks:
+        if task["status"] != Tasks.pending:
+            seconds = get_remaining_seconds(task, rates, bound, now)
+            workers.append(seconds)
+            completions.append(seconds)
+    # ongoing tasks are run by workers, even if not counted as connected
+    workers += [0] * max(nb_workers - len(workers), 0)
+    heapq.heapify(workers)
+
+    schedules = iter(completions)
+    results = []
+    for task in tasks:
+        if task["status"] != Tasks.pending:
+            results.append(next(schedules))
+        elif not workers:
+            results.append(None)
+        else:
+            seconds = heapq.heappop(workers) + get_remaining_seconds(
+                task, rates, bound, now
+            )
+            heapq.heappush(workers, seconds)
+            results.append(seconds)
+    return results
+
+
+def get_load(now=None):
+    """creators load: connected workers, active tasks and their ETA
+
+    ETAs (and overall completion) are given for low, median and high durations
+    of the recently completed tasks. Private channels are not considered"""
+    now = now or datetime.datetime.now()
+    nb_workers = Acknowlegments.count_connected(
+        "creator", since=now - datetime.timedelta(seconds=CONNECTED_SECONDS)
+    )
+    tasks = CreatorTasks.all_active_with_units()
+    rates = get_rates()
+
+    etas = {bound: schedule(tasks, nb_workers, rates, bound, now) for bound in BOUNDS}
+
+    def as_date(seconds):
+        return None if seconds is None else now + datetime.timedelta(seconds=seconds)
+
+    items = []
+    for index, task in enumerate(tasks):
+        items.append(
+            {
+                "_id": task["_id"],
+                "order": task["order"],
+                "channel": task.get("channel"),
+                "worker": task.get("worker"),
+                "status": task["status"],
+                "size_gib": round(get_size_gib(task), 2),
+                "eta": {bound: as_date(etas[bound][index]) for bound in BOUNDS},
+            }
+        )
+
+    # all tasks completed, if they can be
+    if None in etas["median"]:
+        completions = dict.fromkeys(BOUNDS, None)
+    else:
+        completions = {bound: max(etas[bound], default=0) for bound in BOUNDS}
+    cumulative_seconds = sum(
+        get_remaining_seconds(task, rates, "median", now) for task in tasks
+    )
+    return {
+        "connected_workers": nb_workers,
+        "pending_tasks": len(tasks),
+        "cumulative_duration": int(cumulative_seconds // 60),
+        "remaining_minutes": (
+            None if completions["median"] is None else int(completions["median"] // 60)
+        ),
+        "estimated_completion": as_date(completions["median"]),
+        "estimated_completion_band": {
+            bound: as_date(completions[bound]) for bound in ("low", "high")
+        },
+        "rates": rates,
+        "tasks": items,
+    }
@@ -0,0 +1,198 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+# in-process metrics changes are flushed (added to stored ones) after
+METRICS_FLUSH_SECONDS = int(os.getenv("METRICS_FLUSH_SECONDS") or 10)
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    """metrics recorded by this process, not flushed yet
+
+    Changes are kept as increments per metric and labels and periodically
+    handed to a flush function (adding them to shared, stored values) by a
+    thread started on first change in each process (uwsgi workers are forked)"""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flush_func = None
+        self._flusher_pid = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def flush_with(self, func):
+        """have changes flushed by func(changes) from now on"""
+        self._flush_func = func
+
+    def add(self, name, labels, increments):
+        with self._lock:
+            values = self._pending.setdefault((name, labels), {})
+            for key, amount in increments.items():
+                values[key] = values.get(key, 0) + amount
+            if self._flush_func and self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._flush_forever, daemon=True).start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """hand pending changes to flush function, kept if it failed"""
+        with self._lock:
+            changes, self._pending = self._pending, {}
+        if not changes or not self._flush_func:
+            return
+        try:
+            self._flush_func(changes)
+        except Exception as exc:
+            logger.error(f"Failed to flush metrics: {exc!s}")
+            with self._lock:
+                for key, values in changes.items():
+                    pending = self._pending.setdefault(key, {})
+                    for field, amount in values.items():
+                        pending[field] = pending.get(field, 0) + amount
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            self.flush()
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY.register(self)
+
+    def labels_for(self, kwargs):
+        return tuple((label, str(kwargs[label])) for label in self.labels)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        REGISTRY.add(self.name, self.labels_for(labels), {"value": amount})
+
+    def samples(self, labels, values):
+        yield self.name, labels, values.get("value", 0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # counts are stored per bucket and cumulated when rendered
+        bucket = next(
+            (f"b{index}" for index, le in enumerate(self.buckets) if value <= le),
+            "inf",
+        )
+        REGISTRY.add(
+            self.name, self.labels_for(labels), {bucket: 1, "sum": value, "count": 1}
+        )
+
+    def samples(self, labels, values):
+        cumulated = 0
+        for index, le in enumerate(self.buckets):
+            cumulated += values.get(f"b{index}", 0)
+            yield f"{self.name}_bucket", labels + (("le", str(le)),), cumulated
+        yield f"{self.name}_bucket", labels + (("le", "+Inf"),), values.get("count", 0)
+        yield f"{self.name}_sum", labels, values.get("sum", 0)
+        yield f"{self.name}_count", labels, values.get("count", 0)
+
+
+class Gauge(Metric):
+    """value computed when rendered (not recorded)"""
+
+    kind = "gauge"
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_sample(name, labels, value) -> str:
+    if labels:
+        labels = ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+        name = f"{name}{{{labels}}}"
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return f"{name} {value}"
+
+
+def render(values) -> str:
+    """Prometheus text exposition of values: {metric name: {labels: values}}
+
+    labels are tuples of (label, value) ; values are stored ones for counters
+    and histograms, a number for gauges"""
+    lines = []
+    for name, metric in sorted(REGISTRY.metrics.items()):
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for labels, metric_values in sorted(values.get(name, {}).items()):
+            for sample in metric.samples(labels, metric_values):
+                lines.append(format_sample(*sample))
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "cardshop_http_request_duration_seconds",
+    "API requests duration (until response is returned)",
+    labels=("method", "route", "status"),
+)
+TASK_STATUS_SECONDS = Histogram(
+    "cardshop_task_status_duration_seconds",
+    "time tasks spent in a status, observed when leaving it",
+    labels=("type", "status"),
+    buckets=(60, 300, 900, 3600, 4 * 3600, 12 * 3600, 86400, 3 * 86400, 7 * 86400),
+)
+EMAILS_SENT = Counter(
+    "cardshop_emails_sent_total", "emails sent from outbox", labels=("sender",)
+)
+EMAILS_FAILED = Counter(
+    "cardshop_emails_failed_total",
+    "failed attempts at sending emails from outbox",
+    labels=("sender",),
+)
+TASK_LOGS_RECEIVED_BYTES = Counter(
+    "cardshop_task_logs_received_bytes_total",
+    "task logs bytes received from workers (incremental or full uploads)",
+    labels=("type", "kind"),
+)
+PERIODIC_JOB_SECONDS = Histogram(
+    "cardshop_periodic_job_duration_seconds",
+    "periodic jobs runs duration",
+    labels=("job", "result"),
+    buckets=(1, 5, 15, 60, 300, 900, 3600, 6 * 3600),
+)
+TASKS = Gauge(
+    "cardshop_tasks",
+    "pending and in-progress tasks",
+    labels=("type", "channel", "status"),
+)
+EMAILS_QUEUED = Gauge("cardshop_emails_queued", "emails waiting in outbox")
+PERIODIC_JOB_LAST_DURATION = Gauge(
+    "cardshop_periodic_job_last_duration_seconds",
+    "duration of periodic jobs' last recorded run",
+    labels=("job",),
+)
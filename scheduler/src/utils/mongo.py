@@ -1,26 +1,255 @@
 import datetime
+import hashlib
+import json
 import os
+import threading
 
 import humanfriendly
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    IndexModel,
+    MongoClient,
+    ReturnDocument,
+    UpdateOne,
+)
 from pymongo.collection import Collection as BaseCollection
 from pymongo.database import Database as BaseDatabase
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+from utils import metrics
+from utils.cache import MISSING, TTLCache
 from utils.json import ensure_objectid
 
+MONGODB_URI = os.getenv("MONGODB_URI", "mongo")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE") or 50)
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE") or 0)
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS") or 300000)
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS") or 10000)
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS") or 10000
+)
+# 0 (default) means no socket timeout
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS") or 0) or None
+# how long an unchanged worker ack is kept before being refreshed.
+# must remain well below the 15mn used to consider a worker connected
+ACK_REFRESH_SECONDS = int(os.getenv("ACK_REFRESH_SECONDS") or 60)
+AUTOIMAGES_CACHE_SECONDS = int(os.getenv("AUTOIMAGES_CACHE_SECONDS") or 60)
+CHANNELS_CACHE_SECONDS = int(os.getenv("CHANNELS_CACHE_SECONDS") or 60)
+EMAILS_RETENTION_DAYS = int(os.getenv("EMAILS_RETENTION_DAYS") or 30)
+
 
 class Client(MongoClient):
     def __init__(self):
-        super().__init__(host=os.getenv("MONGODB_URI", "mongo"))
+        super().__init__(
+            host=MONGODB_URI,
+            maxPoolSize=MONGODB_MAX_POOL_SIZE,
+            minPoolSize=MONGODB_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+            socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS,
+            # don't connect until first operation (we may be forked before that)
+            connect=False,
+        )
 
 
 class Database(BaseDatabase):
+    def __init__(self, client=None):
+        super().__init__(client or Pool.client(), "Cardshop")
+
+
+class Pool:
+    """Process-wide Client, Database and collection handles
+
+    MongoClient is thread-safe but not fork-safe: uwsgi forks its workers
+    after importing the app so handles are dropped and re-created
+    whenever the PID changes."""
+
+    _lock = threading.RLock()
+    _pid = None
+    _client = None
+    _database = None
+    _collections = {}
+
+    @classmethod
+    def _ensure_process(cls):
+        if cls._pid != os.getpid():
+            cls.reset()
+
+    @classmethod
+    def reset(cls):
+        """forget about handles (without closing: they may belong to parent)"""
+        with cls._lock:
+            cls._pid = os.getpid()
+            cls._client = None
+            cls._database = None
+            cls._collections = {}
+
+    @classmethod
+    def client(cls):
+        with cls._lock:
+            cls._ensure_process()
+            if cls._client is None:
+                cls._client = Client()
+            return cls._client
+
+    @classmethod
+    def database(cls):
+        with cls._lock:
+            cls._ensure_process()
+            if cls._database is None:
+                cls._database = Database(cls.client())
+            return cls._database
+
+    @classmethod
+    def collection(cls, collection_cls):
+        with cls._lock:
+            cls._ensure_process()
+            collection = cls._collections.get(collection_cls)
+            if collection is None:
+                collection = BaseCollection.__new__(collection_cls)
+                BaseCollection.__init__(
+                    collection, cls.database(), collection_cls.collection_name
+                )
+                cls._collections[collection_cls] = collection
+            return collection
+
+    @classmethod
+    def close(cls):
+        """close this process' client (and its connections)"""
+        with cls._lock:
+            if cls._pid == os.getpid() and cls._client is not None:
+                cls._client.close()
+            cls.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Pool.reset)
+
+
+class Collection(BaseCollection):
+    """Collection on the shared Database
+
+    `Users()` returns this process' single Users handle on every call"""
+
+    collection_name: str = None
+    # declared indexes, created (idempotently) by prestart
+    indexes: list = []
+
+    def __new__(cls):
+        return Pool.collection(cls)
+
     def __init__(self):
-        super().__init__(Client(), "Cardshop")
+        # handle already initialized by Pool
+        ...
+
+    @classmethod
+    def concrete_subclasses(cls):
+        """all Collection classes bound to an actual collection"""
+        for subclass in cls.__subclasses__():
+            if subclass.collection_name:
+                yield subclass
+            yield from subclass.concrete_subclasses()
+
 
+class StatusCollection(Collection):
+    """Collection of documents with a `status` and its `statuses` history"""
 
-class Users(BaseCollection):
+    # allowed previous statuses for a new status. Statuses not listed here
+    # can be reached from any (other) status
+    TRANSITIONS = {}
+
+    # named projections (fields profiles) for reads. `full` is whole document
+    PROJECTIONS = {"full": None}
+
+    @classmethod
+    def projection_for(cls, fields="full", with_logs=False):
+        """projection of a fields profile. ValueError if unknown
+
+        logs are only part of the full profile, if requested"""
+        if fields not in cls.PROJECTIONS:
+            raise ValueError(f"Unknown fields profile: {fields}")
+        projection = cls.PROJECTIONS[fields]
+        if projection is None and not with_logs:
+            return {"logs": 0}
+        return projection
+
+    @classmethod
+    def transition_query(cls, query, status):
+        """query restricted to documents that can move to status"""
+        previous = {"$ne": status}
+        if status in cls.TRANSITIONS:
+            previous["$in"] = cls.TRANSITIONS[status]
+        return {"$and": [query, {"status": previous}]}
+
+    @classmethod
+    def transition_one(
+        cls, query, status, payload=None, extra_update=None, on=None, **kwargs
+    ):
+        """atomically change status of a document matching query
+
+        Status is recorded in statuses, entered `on` (now by default). Returns
+        the document (by default, its previous `_id` and `status`) or None if
+        none was updated: missing, already in status or not an allowed
+        transition.
+        kwargs are passed to find_one_and_update (sort, projection, etc)"""
+        update = {"status": status}
+        update.update(extra_update or {})
+        kwargs.setdefault("projection", {"status": 1})
+        return cls().find_one_and_update(
+            cls.transition_query(query, status),
+            {
+                "$set": update,
+                "$push": {
+                    "statuses": {
+                        "status": status,
+                        "on": on or datetime.datetime.now(),
+                        "payload": payload,
+                    }
+                },
+            },
+            **kwargs,
+        )
+
+    @classmethod
+    def transition_many(cls, query, status, payload=None, extra_update=None, on=None):
+        """change status of all documents matching query in a single update
+
+        Same rules as transition_one. Returns the number of updated documents"""
+        update = {"status": status}
+        update.update(extra_update or {})
+        return (
+            cls()
+            .update_many(
+                cls.transition_query(query, status),
+                {
+                    "$set": update,
+                    "$push": {
+                        "statuses": {
+                            "status": status,
+                            "on": on or datetime.datetime.now(),
+                            "payload": payload,
+                        }
+                    },
+                },
+            )
+            .modified_count
+        )
+
+    @classmethod
+    def transition(cls, object_id, status, payload=None, extra_update=None, **kwargs):
+        return cls.transition_one(
+            {"_id": ensure_objectid(object_id)},
+            status,
+            payload=payload,
+            extra_update=extra_update,
+            **kwargs,
+        )
+
+
+class Users(Collection):
     MANAGER_ROLE = "manager"
     CREATOR_ROLE = "creator"
     WRITER_ROLE = "writer"
@@ -44,8 +273,11 @@ class Users(BaseCollection):
         "role": {"type": "string", "required": True},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "users")
+    collection_name = "users"
+    indexes = [
+        IndexModel([("username", ASCENDING)], name="username", unique=True),
+        IndexModel([("email", ASCENDING)], name="email", unique=True),
+    ]
 
     @classmethod
     def by_username(cls, username):
@@ -56,20 +288,34 @@ class Users(BaseCollection):
         return cls().find_one({"role": cls.MANAGER_ROLE})
 
 
-class RefreshTokens(BaseCollection):
-    def __init__(self):
-        super().__init__(Database(), "refresh_tokens")
+class RefreshTokens(Collection):
+    collection_name = "refresh_tokens"
+    indexes = [
+        IndexModel([("token", ASCENDING)], name="token", unique=True),
+        # mongo removes documents once expire_time is reached
+        IndexModel(
+            [("expire_time", ASCENDING)], name="expire_time", expireAfterSeconds=0
+        ),
+    ]
 
 
-class Acknowlegments(BaseCollection):
+class Acknowlegments(Collection):
     idle = "idle"
     busy = "busy"
     not_starting = "not_starting"
     error = "error"
     no_slot = "no_slot"
 
-    def __init__(self):
-        super().__init__(Database(), "acknowlegments")
+    collection_name = "acknowlegments"
+    indexes = [
+        IndexModel(
+            [("username", ASCENDING), ("worker_type", ASCENDING), ("slot", ASCENDING)],
+            name="username_worker_type_slot",
+        ),
+        IndexModel(
+            [("worker_type", ASCENDING), ("on", ASCENDING)], name="worker_type_on"
+        ),
+    ]
 
     schema = {
         "username": {"type": "string", "regex": "^[a-zA-Z0-9_.+-]+$", "required": True},
@@ -84,16 +330,44 @@ class Acknowlegments(BaseCollection):
     def update(
         cls, username, worker_type, slot, status, payload=None, extra={}, on=None
     ):
-        # retrieve previsous status
-        mfilter = {"username": username, "worker_type": worker_type, "slot": slot}
-        existing = cls().find_one(mfilter, {"status"})
-        previous_status = existing["status"] if existing else None
-        # update ack
-        extra.update(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
+        """record worker's status. Returns ack ID and whether status changed
+
+        Unchanged status and payload are not rewritten until ACK_REFRESH_SECONDS.
+        Single (upsert) update, returning previous document"""
+        now = datetime.datetime.now()
+        stale_on = now - datetime.timedelta(seconds=ACK_REFRESH_SECONDS)
+        update = dict(extra)
+        update.update({"status": status, "on": now, "payload": payload})
+
+        # whether to write: missing, changed or stale (evaluated on previous)
+        write = {
+            "$or": [
+                {"$ne": ["$status", {"$literal": status}]},
+                {"$ne": ["$payload", {"$literal": payload}]},
+                {"$lt": ["$on", stale_on]},
+            ]
+        }
+        # known if inserted (no previous document)
+        new_id = ObjectId()
+        previous = cls().find_one_and_update(
+            {"username": username, "worker_type": worker_type, "slot": slot},
+            [
+                {
+                    "$set": {
+                        "_id": {"$ifNull": ["$_id", new_id]},
+                        **{
+                            field: {"$cond": [write, {"$literal": value}, f"${field}"]}
+                            for field, value in update.items()
+                        },
+                    }
+                }
+            ],
+            projection={"status": 1},
+            upsert=True,
         )
-        res = cls().update_one(mfilter, {"$set": extra}, upsert=True)
-        return res.upserted_id or existing["_id"], status != previous_status
+        if previous is None:
+            return new_id, True
+        return previous["_id"], status != previous.get("status")
 
     @classmethod
     def idle_update(cls, username, worker_type, slot):
@@ -128,8 +402,15 @@ class Acknowlegments(BaseCollection):
             raise ValueError("Unable to retrieve ack with id `{}`".format(aid))
         return ack
 
+    @classmethod
+    def count_connected(cls, worker_type, since):
+        """number of worker slots of worker_type that acked since"""
+        return cls().count_documents(
+            {"worker_type": worker_type, "on": {"$gte": since}}
+        )
+
 
-class Channels(BaseCollection):
+class Channels(Collection):
     schema = {
         "slug": {"type": "string", "regex": "^[a-zA-Z0-9_.+-]+$", "required": True},
         "name": {"type": "string", "regex": "^.+$", "required": True},
@@ -143,8 +424,10 @@ class Channels(BaseCollection):
         },
     }
 
-    def __init__(self):
-        super().__init__(Database(), "channels")
+    collection_name = "channels"
+    indexes = [IndexModel([("slug", ASCENDING)], name="slug")]
+    # private channels' slugs, read on every worker poll
+    private_cache = TTLCache(ttl=CHANNELS_CACHE_SECONDS, maxsize=1)
 
     @classmethod
     def get(cls, slug):
@@ -153,8 +436,22 @@ class Channels(BaseCollection):
             raise ValueError("Unable to retrieve channel with slug `{}`".format(slug))
         return channel
 
+    @classmethod
+    def private_slugs(cls):
+        """slugs of private channels, cached for a few seconds"""
+        slugs = cls.private_cache.get("slugs", MISSING)
+        if slugs is MISSING:
+            slugs = cls().distinct("slug", {"private": True})
+            cls.private_cache.set("slugs", slugs)
+        return list(slugs)
+
+    @classmethod
+    def invalidate(cls):
+        """drop cached private slugs (in this process)"""
+        cls.private_cache.clear()
+
 
-class Warehouses(BaseCollection):
+class Warehouses(Collection):
     schema = {
         "slug": {"type": "string", "regex": "^[a-zA-Z0-9_.+-]+$", "required": True},
         "upload_uri": {"type": "string", "regex": "^.+$", "required": True},
@@ -162,8 +459,8 @@ class Warehouses(BaseCollection):
         "active": {"type": "boolean", "default": True, "required": True},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "warehouses")
+    collection_name = "warehouses"
+    indexes = [IndexModel([("slug", ASCENDING)], name="slug")]
 
     @classmethod
     def get(cls, slug):
@@ -173,7 +470,340 @@ class Warehouses(BaseCollection):
         return order
 
 
-class Orders(BaseCollection):
+class Configs(Collection):
+    """Content-addressed store of configs (JSON) and their YAML
+
+    Orders, creator tasks and auto-images only hold `config_hash` and
+    `config_yaml_hash` ; values are expanded when needed"""
+
+    # document field: field holding its hash
+    FIELDS = {"config": "config_hash", "config_yaml": "config_yaml_hash"}
+
+    collection_name = "configs"
+
+    @staticmethod
+    def digest(value):
+        return hashlib.sha256(
+            json.dumps(
+                value, sort_keys=True, separators=(",", ":"), default=str
+            ).encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def store(cls, value):
+        """hash of value, once stored. None for empty values"""
+        if not value:
+            return None
+        digest = cls.digest(value)
+        cls().update_one(
+            {"_id": digest},
+            {"$setOnInsert": {"data": value, "created_on": datetime.datetime.now()}},
+            upsert=True,
+        )
+        return digest
+
+    @classmethod
+    def dehydrate(cls, document):
+        """replace config and config_yaml in document by their hashes (in place)"""
+        for field, hash_field in cls.FIELDS.items():
+            if field in document:
+                document[hash_field] = cls.store(document.pop(field))
+        return document
+
+    @classmethod
+    def hashes_of(cls, document):
+        """config and config_yaml hashes of a (possibly not migrated) document"""
+        return {
+            hash_field: (
+                document[hash_field]
+                if hash_field in document
+                else cls.store(document.get(field))
+            )
+            for field, hash_field in cls.FIELDS.items()
+        }
+
+    @classmethod
+    def expand(cls, documents, fields=("config", "config_yaml"), config_fields=None):
+        """set fields of documents from their hashes (in place), in one query
+
+        config_fields restricts config to those keys (only expanding config).
+        Not migrated documents keep their inline values"""
+        documents = [document for document in documents if document]
+        digests = {
+            document[cls.FIELDS[field]]
+            for document in documents
+            for field in fields
+            if document.get(cls.FIELDS[field])
+        }
+        if not digests:
+            return documents
+
+        projection = (
+            {f"data.{key}": 1 for key in config_fields} if config_fields else None
+        )
+        values = {
+            config["_id"]: config.get("data")
+            for config in cls().find({"_id": {"$in": list(digests)}}, projection)
+        }
+        for document in documents:
+            for field in fields:
+                if document.get(cls.FIELDS[field]):
+                    document[field] = values.get(document[cls.FIELDS[field]])
+        return documents
+
+
+class Migrations(Collection):
+    """progress of (resumable) data migrations"""
+
+    collection_name = "migrations"
+
+    @classmethod
+    def get_checkpoint(cls, name):
+        migration = cls().find_one({"_id": name}, {"checkpoint": 1})
+        return migration["checkpoint"] if migration else None
+
+    @classmethod
+    def set_checkpoint(cls, name, checkpoint, done=False):
+        cls().update_one(
+            {"_id": name},
+            {
+                "$set": {
+                    "checkpoint": checkpoint,
+                    "done": done,
+                    "on": datetime.datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+
+    @classmethod
+    def reset(cls, name):
+        cls().delete_one({"_id": name})
+
+
+class PeriodicJobs(Collection):
+    """last run of each periodic job (by name) and lease of its current runner
+
+    Replicas compete for each job: the one acquiring the lease runs it and
+    renews the lease until done. Each acquisition increments the job's
+    fencing `token`: renewal and end from a runner whose lease was taken
+    over (after it expired) are rejected. Job writes aren't: runners check
+    their token right before those that must not be repeated, which a
+    runner stalled between check and write can still make. Lease dates use
+    the replicas' clocks."""
+
+    collection_name = "periodic_jobs"
+
+    @classmethod
+    def start(cls, name, interval, owner, lease_duration, force=False):
+        """acquire job's lease if due and not leased, returning fencing token
+
+        None if job is not due (unless forced) or leased by a live runner"""
+        now = datetime.datetime.now()
+        query = {
+            "_id": name,
+            "$or": [{"lease_until": None}, {"lease_until": {"$lte": now}}],
+        }
+        if not force:
+            query["last_started_on"] = {
+                "$not": {"$gt": now - datetime.timedelta(seconds=interval)}
+            }
+        try:
+            job = cls().find_one_and_update(
+                query,
+                {
+                    "$set": {
+                        "owner": owner,
+                        "lease_until": now + datetime.timedelta(seconds=lease_duration),
+                        "last_started_on": now,
+                    },
+                    "$inc": {"token": 1},
+                },
+                projection={"token": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # exists but not matching: leased or not due
+            return None
+        return job["token"]
+
+    @classmethod
+    def renew(cls, name, token, lease_duration) -> bool:
+        """extend lease, returning whether it's still held with this token"""
+        return bool(
+            cls()
+            .update_one(
+                {"_id": name, "token": token},
+                {
+                    "$set": {
+                        "lease_until": datetime.datetime.now()
+                        + datetime.timedelta(seconds=lease_duration)
+                    }
+                },
+            )
+            .matched_count
+        )
+
+    @classmethod
+    def holds(cls, name, token) -> bool:
+        """whether lease is held with this token and not expired"""
+        return bool(
+            cls().count_documents(
+                {
+                    "_id": name,
+                    "token": token,
+                    "lease_until": {"$gt": datetime.datetime.now()},
+                },
+                limit=1,
+            )
+        )
+
+    @classmethod
+    def end(cls, name, token, duration, error=None) -> bool:
+        """release lease and record run, unless lease was taken over"""
+        return bool(
+            cls()
+            .update_one(
+                {"_id": name, "token": token},
+                {
+                    "$set": {
+                        "owner": None,
+                        "lease_until": None,
+                        "last_ended_on": datetime.datetime.now(),
+                        "last_duration": duration,
+                        "last_error": error,
+                        "last_succeeded": error is None,
+                    },
+                    "$inc": {"nb_runs": 1, "nb_failures": 0 if error is None else 1},
+                },
+            )
+            .matched_count
+        )
+
+    @classmethod
+    def last_durations(cls):
+        """duration (seconds) of each job's last recorded run"""
+        return {
+            job["_id"]: job["last_duration"]
+            for job in cls().find({}, {"last_duration": 1})
+            if job.get("last_duration") is not None
+        }
+
+    @classmethod
+    def next_due_on(cls, name, interval):
+        """when job will be due again (now if never run)"""
+        job = cls().find_one({"_id": name}, {"last_started_on": 1})
+        if not job or not job.get("last_started_on"):
+            return datetime.datetime.now()
+        return job["last_started_on"] + datetime.timedelta(seconds=interval)
+
+
+class Emails(Collection):
+    """outbox of emails, sent by a background sender (emailing.py)
+
+    An email is a sender function of emailing (by name) and its arguments.
+    Its `key` is unique: queuing the same email twice only queues it once."""
+
+    pending = "pending"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+
+    collection_name = "emails"
+    indexes = [
+        IndexModel([("key", ASCENDING)], name="key", unique=True),
+        IndexModel(
+            [("status", ASCENDING), ("next_attempt_on", ASCENDING)],
+            name="status_next_attempt_on",
+        ),
+        # mongo removes sent and failed emails once expire_on is reached
+        IndexModel([("expire_on", ASCENDING)], name="expire_on", expireAfterSeconds=0),
+    ]
+
+    @classmethod
+    def queue(cls, sender, args, key) -> bool:
+        """add email to outbox, returning whether it wasn't already"""
+        now = datetime.datetime.now()
+        return bool(
+            cls()
+            .update_one(
+                {"key": key},
+                {
+                    "$setOnInsert": {
+                        "sender": sender,
+                        "args": list(args),
+                        "status": cls.pending,
+                        "attempts": 0,
+                        "created_on": now,
+                        "next_attempt_on": now,
+                        "last_error": None,
+                    }
+                },
+                upsert=True,
+            )
+            .upserted_id
+        )
+
+    @classmethod
+    def count_queued(cls):
+        return cls().count_documents({"status": cls.pending})
+
+    @classmethod
+    def claim_next(cls, claim_for):
+        """oldest email due for an attempt, marked as being sent
+
+        If not sent nor failed within claim_for seconds (sender died), it's
+        due again."""
+        now = datetime.datetime.now()
+        return cls().find_one_and_update(
+            {
+                "status": {"$in": [cls.pending, cls.sending]},
+                "next_attempt_on": {"$lte": now},
+            },
+            {
+                "$set": {
+                    "status": cls.sending,
+                    "next_attempt_on": now + datetime.timedelta(seconds=claim_for),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("next_attempt_on", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @classmethod
+    def set_sent(cls, email_id):
+        now = datetime.datetime.now()
+        cls().update_one(
+            {"_id": email_id},
+            {
+                "$set": {
+                    "status": cls.sent,
+                    "sent_on": now,
+                    "expire_on": now + datetime.timedelta(days=EMAILS_RETENTION_DAYS),
+                }
+            },
+        )
+
+    @classmethod
+    def set_failed(cls, email_id, error, retry_on=None):
+        """record failed attempt: retried on retry_on or failed for good"""
+        now = datetime.datetime.now()
+        update = {"last_error": error}
+        if retry_on:
+            update.update({"status": cls.pending, "next_attempt_on": retry_on})
+        else:
+            update.update(
+                {
+                    "status": cls.failed,
+                    "expire_on": now + datetime.timedelta(days=EMAILS_RETENTION_DAYS),
+                }
+            )
+        cls().update_one({"_id": email_id}, {"$set": update})
+
+
+class Orders(StatusCollection):
     virtual = "virtual"
     physical = "physical"
 
@@ -206,6 +836,8 @@ class Orders(BaseCollection):
     FAILED_STATUSES = [creation_failed, download_failed, write_failed, canceled, failed]
     SUCCESS_STATUSES = [shipped, expired]
 
+    TRANSITIONS = {expired: [pending_expiry]}
+
     schema = {
         "config": {"type": "dict", "required": True},
         "config_yaml": {"type": "string", "required": False},
@@ -268,14 +900,64 @@ class Orders(BaseCollection):
         "download_urls": {"type": "list", "required": False},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "orders")
+    PROJECTIONS = {
+        # listings (config can be large: only its name)
+        "summary": {
+            "config.name": 1,
+            "config_hash": 1,
+            "sd_card": 1,
+            "quantity": 1,
+            "units": 1,
+            "client": 1,
+            "recipient": 1,
+            "channel": 1,
+            "warehouse": 1,
+            "status": 1,
+            "statuses": 1,
+            "tasks": 1,
+            "fname": 1,
+        },
+        # status changes, tasks creation and public pages
+        "status": {
+            "sd_card": 1,
+            "quantity": 1,
+            "channel": 1,
+            "warehouse": 1,
+            "status": 1,
+            "statuses": 1,
+            "tasks": 1,
+            "fname": 1,
+            "download_urls": 1,
+        },
+        # notifications (config and YAML to be expanded)
+        "email": {
+            "config": 1,
+            "config_yaml": 1,
+            "config_hash": 1,
+            "config_yaml_hash": 1,
+            "sd_card": 1,
+            "quantity": 1,
+            "units": 1,
+            "client": 1,
+            "recipient": 1,
+            "channel": 1,
+            "status": 1,
+            "statuses": 1,
+            "tasks": 1,
+            "fname": 1,
+            "download_urls": 1,
+        },
+        "full": None,
+    }
+
+    collection_name = "orders"
+    indexes = [IndexModel([("status", ASCENDING)], name="status")]
 
     @classmethod
-    def get(cls, order_id, with_logs=False):
+    def get(cls, order_id, with_logs=False, fields="full"):
         order = cls().find_one(
             {"_id": ensure_objectid(order_id)},
-            projection={"logs": 0} if not with_logs else None,
+            projection=cls.projection_for(fields, with_logs),
         )
         if order is None:
             raise ValueError(
@@ -285,19 +967,12 @@ class Orders(BaseCollection):
 
     @classmethod
     def get_tasks(cls, order_id, with_logs=False):
-        order = cls().get(order_id)
-        return {
-            "create": CreatorTasks().get(
-                order["tasks"].get("create"), with_logs=with_logs
-            ),
-            "download": DownloaderTasks().get(
-                order["tasks"].get("download"), with_logs=with_logs
-            ),
-            "write": [
-                WriterTasks().get(task, with_logs=with_logs)
-                for task in order["tasks"].get("write", [])
-            ],
-        }
+        order = cls.get_with_tasks(order_id, with_logs=with_logs)
+        if order is None:
+            raise ValueError(
+                "Unable to find/retrieve object with ID {}".format(order_id)
+            )
+        return {key: order["tasks"][key] for key in ("create", "download", "write")}
 
     @classmethod
     def get_uploaded_files(cls, order_id):
@@ -307,16 +982,64 @@ class Orders(BaseCollection):
         )
 
     @classmethod
-    def get_with_tasks(cls, order_id, with_logs=False):
-        try:
-            order = cls().get(order_id, with_logs=with_logs)
-        except ValueError:
-            order = None
-        if order is None:
-            return order
-        order["tasks"].update(cls().get_tasks(order_id, with_logs=with_logs))
+    def with_tasks_pipeline(cls, match, with_logs=False, fields="full"):
+        """aggregation pipeline adding `_tasks_<kind>` lists to matching orders"""
+        pipeline = [{"$match": match}]
+        if cls.PROJECTIONS[fields]:
+            pipeline.append({"$project": cls.PROJECTIONS[fields]})
+        projection = {"logs": 0}
+        for kind, tasks_cls in (
+            ("create", CreatorTasks),
+            ("download", DownloaderTasks),
+            ("write", WriterTasks),
+        ):
+            pipeline.append(
+                {
+                    "$lookup": {
+                        "from": tasks_cls.collection_name,
+                        "localField": f"tasks.{kind}",
+                        "foreignField": "_id",
+                        "as": f"_tasks_{kind}",
+                    }
+                }
+            )
+            projection[f"_tasks_{kind}.logs"] = 0
+        if not with_logs:
+            pipeline.append({"$project": projection})
+        return pipeline
+
+    @staticmethod
+    def attach_looked_up_tasks(order):
+        """replace task IDs in order[tasks] with documents from the pipeline"""
+        creates = order.pop("_tasks_create", [])
+        downloads = order.pop("_tasks_download", [])
+        writes = {task["_id"]: task for task in order.pop("_tasks_write", [])}
+        order["tasks"].update(
+            {
+                "create": creates[0] if creates else None,
+                "download": downloads[0] if downloads else None,
+                # $lookup doesn't preserve order of IDs
+                "write": [
+                    writes.get(task_id) for task_id in order["tasks"].get("write", [])
+                ],
+            }
+        )
         return order
 
+    @classmethod
+    def get_with_tasks(cls, order_id, with_logs=False, fields="full"):
+        match = {"_id": ensure_objectid(order_id)}
+        cls.projection_for(fields)  # validates profile
+        for order in cls().aggregate(cls.with_tasks_pipeline(match, with_logs, fields)):
+            order = cls.attach_looked_up_tasks(order)
+            if with_logs:
+                TaskLogs.attach(
+                    [order["tasks"]["create"], order["tasks"]["download"]]
+                    + order["tasks"]["write"]
+                )
+            return order
+        return None
+
     @classmethod
     def update(cls, order_id, update_set):
         cls().update_one({"_id": ObjectId(order_id)}, {"$set": update_set})
@@ -327,6 +1050,10 @@ class Orders(BaseCollection):
         if order is None:
             raise ValueError("Order #{} not exists. can't create task".format(order_id))
 
+        # task only references order's config. we just need its size here
+        config_hashes = Configs.hashes_of(order)
+        Configs.expand([order], fields=("config",), config_fields=["human_size"])
+
         payload = {
             "order": order_id,
             "media_type": order["sd_card"]["type"],
@@ -336,9 +1063,9 @@ class Orders(BaseCollection):
             "upload_uris": order["warehouse"]["upload_uris"],
             "download_uris": order["warehouse"]["download_uris"],
             "worker": None,
-            "config": order["config"],
-            "config_yaml": order.get("config_yaml", ""),
+            **config_hashes,
             "size": order["sd_card"]["size"],
+            "expected_size": Tasks.expected_size_of(order),
             "logs": {"worker": None, "installer": None, "uploader": None},
             "status": CreatorTasks.pending,
             "statuses": [
@@ -355,9 +1082,9 @@ class Orders(BaseCollection):
         return task_id
 
     @classmethod
-    def cancel(cls, order_id):
-        cls.update_status(order_id, cls.canceled)
-        order = cls.get(order_id)
+    def cancel(cls, order_id, on=None):
+        cls.update_status(order_id, cls.canceled, on=on)
+        order = cls.get(order_id, fields="status")
         if order["tasks"].get("create"):
             CreatorTasks().cancel(order["tasks"].get("create"))
         if order["tasks"].get("download"):
@@ -368,7 +1095,7 @@ class Orders(BaseCollection):
 
     @classmethod
     def create_downloader_task(cls, order_id, upload_details):
-        order = cls.get(order_id)
+        order = cls.get(order_id, fields="status")
         if order is None:
             raise ValueError("Order #{} not exists. can't create task".format(order_id))
 
@@ -381,6 +1108,7 @@ class Orders(BaseCollection):
             "image_fname": upload_details.get("fname"),
             "image_checksum": upload_details.get("checksum"),
             "image_size": upload_details.get("size"),
+            "expected_size": upload_details.get("size"),
             "logs": {"worker": None, "downloader": None},
             "status": DownloaderTasks.pending,
             "statuses": [
@@ -398,7 +1126,7 @@ class Orders(BaseCollection):
 
     @classmethod
     def create_writer_tasks(cls, order_id):
-        order = cls.get_with_tasks(order_id)
+        order = cls.get_with_tasks(order_id, fields="status")
         if order is None:
             raise ValueError("Order #{} not exists. can't create task".format(order_id))
 
@@ -410,6 +1138,7 @@ class Orders(BaseCollection):
             "image_fname": order["tasks"]["download"]["image_fname"],
             "image_checksum": order["tasks"]["download"]["image_checksum"],
             "image_size": order["tasks"]["download"]["image_size"],
+            "expected_size": order["tasks"]["download"]["image_size"],
             "logs": {"worker": None, "downloader": None},
             "status": DownloaderTasks.pending,
             "statuses": [
@@ -419,7 +1148,8 @@ class Orders(BaseCollection):
 
         task_ids = []
         for _ in range(0, order["quantity"]):
-            task_ids.append(WriterTasks().insert_one(payload).inserted_id)
+            # insert_one adds an _id to the passed document
+            task_ids.append(WriterTasks().insert_one(dict(payload)).inserted_id)
 
         # add task_id to order
         cls().update_one(
@@ -429,31 +1159,22 @@ class Orders(BaseCollection):
         return task_ids
 
     @classmethod
-    def update_status(cls, order_id, status, payload=None, extra_update={}):
-        order = cls.get(order_id)
-        # don't update if still current status
-        if status == order["status"]:
-            return
-        statuses = order["statuses"]
-        statuses.append(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
+    def update_status(cls, order_id, status, payload=None, extra_update={}, on=None):
+        return cls.transition(
+            order_id, status, payload=payload, extra_update=extra_update, on=on
         )
-        update = {"status": status, "statuses": statuses}
-        update.update(extra_update)
-        cls().update_one({"_id": ObjectId(order_id)}, {"$set": update})
 
     @classmethod
-    def add_shipment(cls, order_id, shipment_details):
+    def add_shipment(cls, order_id, shipment_details, on=None):
         update = {"recipient.shipment": shipment_details}
         cls().update_one({"_id": ObjectId(order_id)}, {"$set": update})
-        cls().update_status(order_id, Orders.shipped)
+        cls().update_status(order_id, Orders.shipped, on=on)
 
     @classmethod
     def all_pending_expiry(cls):
-        return [
-            cls().get(res["_id"])
-            for res in cls().find({"status": cls.pending_expiry}, {"_id": 1})
-        ]
+        return list(
+            cls().find({"status": cls.pending_expiry}, cls.projection_for("status"))
+        )
 
     @classmethod
     def anonymize(cls, order_ids):
@@ -480,7 +1201,7 @@ class Orders(BaseCollection):
         )
 
 
-class Tasks(BaseCollection):
+class Tasks(StatusCollection):
     pending = "pending"
     received = "received"
 
@@ -562,16 +1283,124 @@ class Tasks(BaseCollection):
     WRITER_SUCCESS_STATUSES = [written]
     SUCCESS_STATUSES = CREATOR_SUCCESS_STATUSES + WRITER_SUCCESS_STATUSES
 
+    # extra conditions for a pending task to be available
+    AVAILABLE_QUERY = {}
+    # max number of tasks returned to a polling worker
+    MAX_AVAILABLES = int(os.getenv("MAX_AVAILABLE_TASKS") or 20)
+    PROJECTIONS = {
+        # what workers need to pick a task (full document is fetched once claimed)
+        "summary": {
+            "order": 1,
+            "channel": 1,
+            "worker": 1,
+            "status": 1,
+            "fname": 1,
+            "media_type": 1,
+            "size": 1,
+            "image_size": 1,
+        },
+        # status changes (image is passed on to the downloader task once uploaded)
+        "status": {
+            "order": 1,
+            "worker": 1,
+            "status": 1,
+            "expected_size": 1,
+            "config.human_size": 1,
+            "image_size": 1,
+            "image": 1,
+        },
+        "full": None,
+    }
+
+    TRANSITIONS = {
+        # a single worker can register a task
+        received: [pending],
+        # a task that progressed meanwhile is not timed out
+        timedout: IN_PROGRESS_STATUSES,
+    }
+
+    # time allowed in an in-progress status before the task is timed out.
+    # transfers (upload, download, write) are given expected_size at this rate
+    STATUS_TIMEOUTS = {
+        building: datetime.timedelta(hours=36),
+        wiping_sdcard: datetime.timedelta(minutes=30),
+    }
+    MIN_TRANSFER_BPS = int(humanfriendly.parse_size("4MiB") / 8)
+    # when we don't know the expected size
+    DEFAULT_TIMEOUT = datetime.timedelta(hours=36)
+
+    indexes = [
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("deadline", ASCENDING)], name="deadline"),
+    ]
+
     @classmethod
-    def get(cls, task_id, with_logs=False):
-        return cls().find_one(
+    def get(cls, task_id, with_logs=False, fields="full"):
+        task = cls().find_one(
             {"_id": ensure_objectid(task_id)},
-            projection={"logs": 0} if not with_logs else None,
+            projection=cls.projection_for(fields, with_logs),
         )
+        if task and with_logs:
+            TaskLogs.attach([task])
+        return task
+
+    @classmethod
+    def transition_one(
+        cls, query, status, payload=None, extra_update=None, on=None, **kwargs
+    ):
+        """same as StatusCollection's, recording time spent in previous status"""
+        on = on or datetime.datetime.now()
+        kwargs.setdefault("projection", {"status": 1, "statuses": {"$slice": -1}})
+        task = super().transition_one(
+            query, status, payload=payload, extra_update=extra_update, on=on, **kwargs
+        )
+        statuses = (task or {}).get("statuses") or []
+        # returned task is either after (ends with new status) or before
+        if kwargs.get("return_document") == ReturnDocument.AFTER:
+            previous = statuses[-2] if len(statuses) >= 2 else None
+            left_on = statuses[-1]["on"] if previous else None
+        else:
+            previous = statuses[-1] if statuses else None
+            left_on = on
+        if previous:
+            metrics.TASK_STATUS_SECONDS.observe(
+                (left_on - previous["on"]).total_seconds(),
+                type=cls.task_type(),
+                status=previous["status"],
+            )
+        return task
+
+    @classmethod
+    def task_type(cls):
+        return cls.collection_name.replace("_tasks", "")
+
+    @classmethod
+    def count_by_channel_and_status(cls):
+        """number of pending and working tasks per (channel, status)"""
+        return {
+            (group["_id"]["channel"], group["_id"]["status"]): group["count"]
+            for group in cls().aggregate(
+                [
+                    {
+                        "$match": {
+                            "status": {
+                                "$in": cls.PENDING_STATUSES + cls.WORKING_STATUSES
+                            }
+                        }
+                    },
+                    {
+                        "$group": {
+                            "_id": {"channel": "$channel", "status": "$status"},
+                            "count": {"$sum": 1},
+                        }
+                    },
+                ]
+            )
+        }
 
     @classmethod
     def cascade_status(cls, task_id, task_status):
-        task = cls.get(task_id)
+        task = cls.get(task_id, fields="status")
 
         cascade_map = {
             Tasks.received: Orders.creating,
@@ -619,62 +1448,184 @@ class Tasks(BaseCollection):
         downloader_log=None,
         wipe_log=None,
         writer_log=None,
+        offsets=None,
     ):
-        if worker_log is None and installer_log is None:
-            return
-        update = {}
-        if worker_log is not None:
-            update.update({"logs.worker": worker_log})
-        if installer_log is not None:
-            update.update({"logs.installer": installer_log})
-        if uploader_log is not None:
-            update.update({"logs.uploader": uploader_log})
-        if downloader_log is not None:
-            update.update({"logs.downloader": downloader_log})
-        if wipe_log is not None:
-            update.update({"logs.wipe": wipe_log})
-        if writer_log is not None:
-            update.update({"logs.writer": writer_log})
-
-        cls().update_one({"_id": ObjectId(task_id)}, {"$set": update})
-
-    @classmethod
-    def update_status(cls, task_id, status, payload=None, extra_update={}):
-        task = cls.get(task_id)
-        statuses = task["statuses"]
-        statuses.append(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
-        )
-        update = {"status": status, "statuses": statuses}
-        update.update(extra_update)
-        cls().update_one({"_id": ObjectId(task_id)}, {"$set": update})
+        """append received logs (found at offsets, default 0) to task's logs
+
+        Returns the stored size of each received log kind"""
+        offsets = offsets or {}
+        logs = {
+            "worker": worker_log,
+            "installer": installer_log,
+            "uploader": uploader_log,
+            "downloader": downloader_log,
+            "wipe": wipe_log,
+            "writer": writer_log,
+        }
+        return {
+            kind: TaskLogs.append(task_id, kind, text, offset=offsets.get(kind) or 0)
+            for kind, text in logs.items()
+            if text is not None
+        }
+
+    @classmethod
+    def update_status(
+        cls,
+        task_id,
+        status,
+        payload=None,
+        extra_update={},
+        expected_size=None,
+        on=None,
+    ):
+        """change status, setting deadline when entering an in-progress status
+
+        expected_size (bytes) is looked up if not provided and needed"""
+        extra_update = dict(extra_update)
+        extra_update["deadline"] = None
+        if status in cls.IN_PROGRESS_STATUSES:
+            if expected_size is None and status not in cls.STATUS_TIMEOUTS:
+                expected_size = cls.get_size(task_id)
+            extra_update["deadline"] = cls.deadline_for(status, expected_size, since=on)
+            if expected_size is not None:
+                extra_update["expected_size"] = expected_size
+        return cls.transition(
+            task_id, status, payload=payload, extra_update=extra_update, on=on
+        )
+
+    @classmethod
+    def deadline_for(cls, status, expected_size=None, since=None):
+        """datetime after which a task in (in-progress) status is timed out"""
+        since = since or datetime.datetime.now()
+        if status in cls.STATUS_TIMEOUTS:
+            return since + cls.STATUS_TIMEOUTS[status]
+        if not expected_size:
+            return since + cls.DEFAULT_TIMEOUT
+        return since + datetime.timedelta(
+            seconds=int(expected_size / cls.MIN_TRANSFER_BPS)
+        )
+
+    @staticmethod
+    def expected_size_of(task):
+        """size (bytes) of the image a task builds or transfers, if known"""
+        if task.get("expected_size"):
+            return task["expected_size"]
+        if (task.get("config") or {}).get("human_size"):
+            return humanfriendly.parse_size(task["config"]["human_size"])
+        return task.get("image_size")
+
+    @classmethod
+    def time_out_expired(cls, now=None):
+        """time out all in-progress tasks past their deadline, in bulk
+
+        Returns timed out tasks (`_id`, `order` and `status` before timeout)"""
+        now = now or datetime.datetime.now()
+        expired = list(
+            cls().find(
+                {"status": {"$in": cls.IN_PROGRESS_STATUSES}, "deadline": {"$lt": now}},
+                {"order": 1, "status": 1},
+            )
+        )
+        if not expired:
+            return []
+
+        # tasks that progressed meanwhile have a new deadline (or none)
+        ids = [task["_id"] for task in expired]
+        cls.transition_many(
+            {"_id": {"$in": ids}, "deadline": {"$lt": now}},
+            cls.timedout,
+            extra_update={"deadline": None},
+            on=now,
+        )
+        timedout_ids = {
+            task["_id"]
+            for task in cls().find(
+                {"_id": {"$in": ids}, "status": cls.timedout}, {"_id": 1}
+            )
+        }
+        return [task for task in expired if task["_id"] in timedout_ids]
+
+    @classmethod
+    def set_missing_deadlines(cls):
+        """set deadline on in-progress tasks that entered status without one"""
+        count = 0
+        for task in cls().find(
+            {"status": {"$in": cls.IN_PROGRESS_STATUSES}, "deadline": None},
+            {"logs": 0},
+        ):
+            deadline = cls.deadline_for(
+                task["status"],
+                cls.expected_size_of(task),
+                since=task["statuses"][-1]["on"],
+            )
+            count += (
+                cls()
+                .update_one(
+                    {"_id": task["_id"], "status": task["status"]},
+                    {"$set": {"deadline": deadline}},
+                )
+                .modified_count
+            )
+        return count
 
     @classmethod
     def register(cls, task_id, worker):
-        cls.update_status(
-            task_id=task_id,
+        """assign pending task to worker. Task (without logs) or None if taken"""
+        return cls.transition_one(
+            {
+                "_id": ensure_objectid(task_id),
+                "worker": {"$in": [None, worker["username"]]},
+            },
             status=cls.received,
             extra_update={"worker": worker["username"]},
             payload="assigned worker: {}".format(worker["username"]),
+            projection={"logs": 0},
+            return_document=ReturnDocument.AFTER,
         )
 
     @classmethod
-    def find_availables(cls, channel):
-        tasks = [
-            cls.get(task.get("_id"))
-            for task in cls().find({"status": cls.pending}, {"_id": 1})
-        ]
-        return tasks
+    def register_next(cls, worker):
+        """assign next available task to worker. Task (without logs) or None
+
+        Tasks already assigned to this worker come first, then oldest"""
+        return cls.transition_one(
+            cls.availables_query(
+                channel=worker.get("channel"), worker=worker["username"]
+            ),
+            status=cls.received,
+            extra_update={"worker": worker["username"]},
+            payload="assigned worker: {}".format(worker["username"]),
+            projection={"logs": 0},
+            sort=[("worker", DESCENDING), ("_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
 
     @classmethod
-    def all_inprogress(cls):
-        tasks = []
-        for tcls in (CreatorTasks, DownloaderTasks, WriterTasks):
-            xtasks = tcls().find(
-                {"status": {"$in": cls.IN_PROGRESS_STATUSES}}, {"_id": 1}
+    def availables_query(cls, channel=None, worker=None):
+        """pending tasks a worker (of channel) can take
+
+        Workers see tasks of public channels and of their own channel only"""
+        query = {"status": cls.pending}
+        query.update(cls.AVAILABLE_QUERY)
+        if worker:
+            query["worker"] = {"$in": [None, worker]}
+        others_private = [slug for slug in Channels.private_slugs() if slug != channel]
+        if others_private:
+            query["channel"] = {"$nin": others_private}
+        return query
+
+    @classmethod
+    def find_availables(cls, channel, worker=None, fields="full", limit=None):
+        """available tasks, in register_next order"""
+        return list(
+            cls()
+            .find(
+                cls.availables_query(channel=channel, worker=worker),
+                cls.projection_for(fields),
             )
-            tasks += [(tcls, tcls.get(t["_id"])) for t in xtasks]
-        return tasks
+            .sort([("worker", DESCENDING), ("_id", ASCENDING)])
+            .limit(min(limit or cls.MAX_AVAILABLES, cls.MAX_AVAILABLES))
+        )
 
     @classmethod
     def cancel(cls, task_id):
@@ -682,11 +1633,11 @@ class Tasks(BaseCollection):
 
     @classmethod
     def get_size(cls, task_id):
-        task = cls.get(task_id)
-        if cls in (CreatorTasks,):
-            return humanfriendly.parse_size(task["config"]["human_size"])
-        if cls in ((DownloaderTasks, WriterTasks)):
-            return task["image_size"]
+        task = cls().find_one(
+            {"_id": ensure_objectid(task_id)},
+            {"expected_size": 1, "config.human_size": 1, "image_size": 1},
+        )
+        return cls.expected_size_of(task) if task else None
 
 
 class CreatorTasks(Tasks):
@@ -705,8 +1656,78 @@ class CreatorTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "creator_tasks")
+    collection_name = "creator_tasks"
+
+    # tasks without YAML config can't be built by workers
+    AVAILABLE_QUERY = {
+        "$or": [
+            {"config_yaml_hash": {"$ne": None}},
+            # not migrated yet
+            {"config_yaml": {"$nin": [None, ""]}},
+        ]
+    }
+
+    # pending or not completed yet
+    ACTIVE_STATUSES = [
+        Tasks.pending,
+        Tasks.received,
+        Tasks.building,
+        Tasks.built,
+        Tasks.uploading,
+    ]
+
+    @classmethod
+    def all_active_with_units(cls):
+        """active tasks (oldest first) with their order's `units`, in one query
+
+        `since` is when task entered its current status. Tasks which order
+        is missing are left out"""
+        return list(
+            cls().aggregate(
+                [
+                    {"$match": {"status": {"$in": cls.ACTIVE_STATUSES}}},
+                    {"$sort": {"_id": ASCENDING}},
+                    {
+                        "$lookup": {
+                            "from": Orders.collection_name,
+                            "localField": "order",
+                            "foreignField": "_id",
+                            "as": "_order",
+                        }
+                    },
+                    {"$unwind": "$_order"},
+                    {
+                        "$project": {
+                            "order": 1,
+                            "channel": 1,
+                            "worker": 1,
+                            "status": 1,
+                            "expected_size": 1,
+                            "since": {"$arrayElemAt": ["$statuses.on", -1]},
+                            "units": "$_order.units",
+                        }
+                    },
+                ]
+            )
+        )
+
+    @classmethod
+    def all_recently_completed(cls, limit):
+        """statuses and sizes of the last `limit` successful tasks"""
+        return list(
+            cls()
+            .find(
+                {"status": {"$in": cls.CREATOR_SUCCESS_STATUSES}},
+                {
+                    "statuses.status": 1,
+                    "statuses.on": 1,
+                    "image.size": 1,
+                    "expected_size": 1,
+                },
+            )
+            .sort([("_id", DESCENDING)])
+            .limit(limit)
+        )
 
 
 class DownloaderTasks(Tasks):
@@ -723,8 +1744,7 @@ class DownloaderTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "downloader_tasks")
+    collection_name = "downloader_tasks"
 
 
 class WriterTasks(Tasks):
@@ -741,11 +1761,128 @@ class WriterTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "writer_tasks")
+    collection_name = "writer_tasks"
+
+
+class TaskLogs(Collection):
+    """Append-only task logs, stored as chunks of text with their offset
+
+    A task's log of a kind (worker, installer, etc) is the concatenation
+    of its chunks. Offsets and sizes are in characters"""
+
+    # max characters in a single chunk
+    CHUNK_SIZE = int(os.getenv("LOG_CHUNK_SIZE") or 2**20)
+
+    collection_name = "task_logs"
+    indexes = [
+        IndexModel(
+            [("task", ASCENDING), ("kind", ASCENDING), ("offset", ASCENDING)],
+            name="task_kind_offset",
+            unique=True,
+        )
+    ]
+
+    @classmethod
+    def size(cls, task_id, kind):
+        """number of characters stored for task's kind"""
+        last = cls().find_one(
+            {"task": ensure_objectid(task_id), "kind": kind},
+            {"offset": 1, "size": 1},
+            sort=[("offset", DESCENDING)],
+        )
+        return last["offset"] + last["size"] if last else 0
+
+    @classmethod
+    def append(cls, task_id, kind, text, offset=0):
+        """record text found at offset in task's kind log. Returns stored size
+
+        Already stored part of text is ignored. Nothing is stored if text
+        starts after the stored size (gap): sender should resend from it.
+        A full log (offset 0) which doesn't extend stored one replaces it:
+        older workers resend their whole logs, which may have been rewritten"""
+        task_id = ensure_objectid(task_id)
+        if offset == 0 and text:
+            stored = cls.get_log(task_id, kind)
+            if not text.startswith(stored) and not stored.startswith(text):
+                return cls.replace(task_id, kind, text)
+        for _ in range(3):
+            size = cls.size(task_id, kind)
+            if offset > size or offset + len(text) <= size:
+                return size
+
+            new_text = text[size - offset :]
+            chunks = []
+            for index in range(0, len(new_text), cls.CHUNK_SIZE):
+                data = new_text[index : index + cls.CHUNK_SIZE]
+                chunks.append(
+                    {
+                        "task": task_id,
+                        "kind": kind,
+                        "offset": size + index,
+                        "size": len(data),
+                        "data": data,
+                        "on": datetime.datetime.now(),
+                    }
+                )
+            try:
+                cls().insert_many(chunks, ordered=True)
+            except BulkWriteError:
+                # concurrent append for same offset. retry from new size
+                continue
+            return size + len(new_text)
+        return cls.size(task_id, kind)
+
+    @classmethod
+    def replace(cls, task_id, kind, text):
+        """replace task's kind log with text. Returns stored size"""
+        task_id = ensure_objectid(task_id)
+        cls().delete_many({"task": task_id, "kind": kind})
+        return cls.append(task_id, kind, text)
+
+    @classmethod
+    def get_log(cls, task_id, kind):
+        """stored log of task's kind (empty if none)"""
+        return "".join(
+            chunk["data"]
+            for chunk in cls()
+            .find({"task": ensure_objectid(task_id), "kind": kind}, {"data": 1})
+            .sort([("offset", ASCENDING)])
+        )
+
+    @classmethod
+    def get_logs(cls, task_ids):
+        """{task_id: {kind: log}} of stored logs for those tasks"""
+        chunks = {}
+        for chunk in (
+            cls()
+            .find({"task": {"$in": list(task_ids)}}, {"_id": 0, "size": 0, "on": 0})
+            .sort([("task", ASCENDING), ("kind", ASCENDING), ("offset", ASCENDING)])
+        ):
+            chunks.setdefault(chunk["task"], {}).setdefault(chunk["kind"], []).append(
+                chunk["data"]
+            )
+        return {
+            task_id: {kind: "".join(data) for kind, data in kinds.items()}
+            for task_id, kinds in chunks.items()
+        }
 
+    @classmethod
+    def delete_for(cls, task_id):
+        """remove all logs of task, returning number of removed chunks"""
+        return cls().delete_many({"task": ensure_objectid(task_id)}).deleted_count
 
-class AutoImages(BaseCollection):
+    @classmethod
+    def attach(cls, tasks):
+        """set stored logs into tasks' `logs` (over legacy in-document ones)"""
+        tasks = [task for task in tasks if task]
+        logs = cls.get_logs(task["_id"] for task in tasks)
+        for task in tasks:
+            task["logs"] = task.get("logs") or {}
+            task["logs"].update(logs.get(task["_id"], {}))
+        return tasks
+
+
+class AutoImages(Collection):
     schema = {
         "slug": {"type": "string", "regex": "^[a-zA-Z0-9_.+-]+$", "required": True},
         "private": {"type": "boolean", "default": True, "required": True},
@@ -784,8 +1921,23 @@ class AutoImages(BaseCollection):
         "woo_id": {"type": "integer", "required": False},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "autoimages")
+    collection_name = "autoimages"
+    indexes = [
+        IndexModel([("slug", ASCENDING)], name="slug"),
+        IndexModel([("status", ASCENDING)], name="status"),
+    ]
+    # public document (/json and /redirect), cached by slug
+    JSON_PROJECTION = {
+        "slug": 1,
+        "private": 1,
+        "http_url": 1,
+        "torrent_url": 1,
+        "http_urls": 1,
+        "torrent_urls": 1,
+        "expire_on": 1,
+        "_id": 0,
+    }
+    json_cache = TTLCache(ttl=AUTOIMAGES_CACHE_SECONDS)
 
     @classmethod
     def get(cls, slug):
@@ -812,9 +1964,24 @@ class AutoImages(BaseCollection):
     def all_currently_building(cls):
         return cls().find({"status": "building"})
 
+    @classmethod
+    def get_json(cls, slug):
+        """public document of an image (or None), cached for a few seconds"""
+        image = cls.json_cache.get(slug, MISSING)
+        if image is MISSING:
+            image = cls().find_one({"slug": slug}, cls.JSON_PROJECTION)
+            cls.json_cache.set(slug, image)
+        return None if image is None else dict(image)
+
+    @classmethod
+    def invalidate(cls, slug):
+        """drop cached document of slug (in this process)"""
+        cls.json_cache.pop(slug)
+
     @classmethod
     def update_status(cls, slug, **update):
         cls().update_one({"slug": slug}, {"$set": update})
+        cls.invalidate(slug)
 
     @classmethod
     def all_ready(cls):
@@ -823,6 +1990,7 @@ class AutoImages(BaseCollection):
     @classmethod
     def create_order_payload(cls, slug):
         image = cls.get(slug)
+        Configs.expand([image])
         warehouse = Warehouses.get(image["warehouse"])
         upload_uris = [
             item.strip() for item in warehouse["upload_uri"].split(",") if item.strip()
@@ -877,7 +2045,7 @@ class AutoImages(BaseCollection):
         )
 
 
-class StripeCustomer(BaseCollection):
+class StripeCustomer(Collection):
     schema = {
         "email": {
             "type": "string",
@@ -890,8 +2058,8 @@ class StripeCustomer(BaseCollection):
         "username": {"type": "string", "required": False},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "stripe_customer")
+    collection_name = "stripe_customer"
+    indexes = [IndexModel([("email", ASCENDING)], name="email")]
 
     @classmethod
     def create(cls, email, customer_id):
@@ -905,7 +2073,7 @@ class StripeCustomer(BaseCollection):
         return None if not record else record.get("customer_id")
 
 
-class StripeSession(BaseCollection):
+class StripeSession(Collection):
     schema = {
         "session_id": {"type": "string", "required": True},
         "customer_id": {"type": "string", "required": True},
@@ -920,8 +2088,11 @@ class StripeSession(BaseCollection):
         "http_url": {"type": "string", "required": False},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "stripe_session")
+    collection_name = "stripe_session"
+    indexes = [
+        IndexModel([("session_id", ASCENDING)], name="session_id"),
+        IndexModel([("invoice_num", ASCENDING)], name="invoice_num", sparse=True),
+    ]
 
     @classmethod
     def create(
@@ -968,7 +2139,7 @@ class StripeSession(BaseCollection):
         cls().update_one({"_id": record_id}, {"$set": update})
 
 
-class UploadedFiles(BaseCollection):
+class UploadedFiles(Collection):
     pending: str = "pending"
     confirmed: str = "confirmed"
     schema = {
@@ -978,10 +2149,23 @@ class UploadedFiles(BaseCollection):
         "download_url": {"type": "string", "required": True},
         "created_on": {"type": "datetime", "required": False},
         "confirmed_on": {"type": "datetime", "required": False},
+        # date in marker file (as we set it), checked against storage on checked_on
+        "expire_on": {"type": "datetime", "required": False, "nullable": True},
+        "checked_on": {"type": "datetime", "required": False, "nullable": True},
     }
 
-    def __init__(self):
-        super().__init__(Database(), "uploaded_files")
+    collection_name = "uploaded_files"
+    indexes = [
+        IndexModel([("download_url", ASCENDING)], name="download_url"),
+        IndexModel([("status", ASCENDING), ("created_on", ASCENDING)], name="status"),
+        IndexModel(
+            [("status", ASCENDING), ("expire_on", ASCENDING)], name="status_expire_on"
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("checked_on", ASCENDING)],
+            name="status_checked_on",
+        ),
+    ]
 
     @classmethod
     def create(
@@ -1015,3 +2199,96 @@ class UploadedFiles(BaseCollection):
     @classmethod
     def update(cls, record_id, **update):
         cls().update_one({"_id": record_id}, {"$set": update})
+
+    @classmethod
+    def set_expire_on(cls, record_id, expire_on, checked_on=None):
+        """record expiration date written to (or read from) marker file"""
+        update = {"expire_on": expire_on}
+        if checked_on:
+            update["checked_on"] = checked_on
+        cls.update(record_id, **update)
+
+    @classmethod
+    def earliest_expiry(cls, download_urls):
+        """closest recorded expiration date of those files (None if unknown)"""
+        file = cls().find_one(
+            {"download_url": {"$in": download_urls}, "expire_on": {"$ne": None}},
+            {"expire_on": 1},
+            sort=[("expire_on", ASCENDING)],
+        )
+        return file["expire_on"] if file else None
+
+    @classmethod
+    def all_expiring(cls, before, download_urls=None):
+        """confirmed files expiring before date (or of unknown expiration)"""
+        query = {
+            "status": cls.confirmed,
+            "$or": [{"expire_on": {"$lte": before}}, {"expire_on": None}],
+        }
+        if download_urls is not None:
+            query["download_url"] = {"$in": download_urls}
+        return cls().find(query)
+
+    @classmethod
+    def all_expired(cls, now):
+        return cls().find({"status": cls.confirmed, "expire_on": {"$lt": now}})
+
+    @classmethod
+    def all_unchecked_since(cls, since, limit):
+        """confirmed files whose expiration wasn't checked against storage since"""
+        return (
+            cls()
+            .find(
+                {
+                    "status": cls.confirmed,
+                    "$or": [{"checked_on": {"$lt": since}}, {"checked_on": None}],
+                }
+            )
+            .sort([("checked_on", ASCENDING)])
+            .limit(limit)
+        )
+
+
+class Metrics(Collection):
+    """counters and histograms (utils.metrics) of all processes and replicas
+
+    Each process adds its changes periodically, in a single bulk write"""
+
+    collection_name = "metrics"
+
+    @staticmethod
+    def key_for(name, labels):
+        return "|".join([name] + [f"{label}={value}" for label, value in labels])
+
+    @classmethod
+    def increment(cls, changes):
+        """add {(name, labels): {field: amount}} changes to stored values"""
+        cls().bulk_write(
+            [
+                UpdateOne(
+                    {"_id": cls.key_for(name, labels)},
+                    {
+                        "$setOnInsert": {"name": name, "labels": labels},
+                        "$inc": {
+                            f"values.{field}": amount
+                            for field, amount in increments.items()
+                        },
+                    },
+                    upsert=True,
+                )
+                for (name, labels), increments in changes.items()
+            ],
+            ordered=False,
+        )
+
+    @classmethod
+    def all_values(cls):
+        """stored values per metric name and labels (tuple of pairs)"""
+        values = {}
+        for metric in cls().find():
+            labels = tuple(tuple(pair) for pair in metric["labels"])
+            values.setdefault(metric["name"], {})[labels] = metric["values"]
+        return values
+
+
+metrics.REGISTRY.flush_with(Metrics.increment)
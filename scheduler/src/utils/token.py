@@ -1,4 +1,7 @@
 import json
+import logging
+import os
+import pathlib
 import random
 import string
 import uuid
@@ -7,11 +10,32 @@ from datetime import datetime, timedelta
 import jwt
 from bson.objectid import ObjectId
 
+logger = logging.getLogger(__name__)
 
-class AccessToken:
-    secret = "".join(
+JWT_SECRET = os.getenv("JWT_SECRET")
+JWT_SECRET_PATH = os.getenv("JWT_SECRET_PATH")
+
+
+def get_secret() -> str:
+    """signing key shared by all processes (from environ or file)
+
+    Falls back to a random key which is only valid in the current process
+    and its forks: tokens are rejected by other replicas and after restart"""
+    if JWT_SECRET:
+        return JWT_SECRET
+    if JWT_SECRET_PATH:
+        secret = pathlib.Path(JWT_SECRET_PATH).read_text().strip()
+        if not secret:
+            raise ValueError(f"Empty JWT secret file: {JWT_SECRET_PATH}")
+        return secret
+    logger.warning("JWT_SECRET not set, using a random per-process signing key")
+    return "".join(
         [random.choice(string.ascii_letters + string.digits) for _ in range(32)]
     )
+
+
+class AccessToken:
+    secret = get_secret()
     issuer = "scheduler"
 
     class JSONEncoder(json.JSONEncoder):
@@ -1,6 +1,15 @@
+import pathlib
+import sys
+
 import pytest
 import requests
 
+# database used (then dropped) by tests needing MongoDB
+TEST_DATABASE = "Cardshop_test"
+
+# scheduler code (src/) is imported by tests not going through the API
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
 
 @pytest.fixture(scope="module")
 def root() -> str:
@@ -24,3 +33,52 @@ def access_token(authorize):
 @pytest.fixture(scope="class")
 def refresh_token(authorize):
     return authorize["refresh_token"]
+
+
+@pytest.fixture(scope="module")
+def database():
+    """utils.mongo on a throwaway database of MONGODB_URI (dropped afterwards)
+
+    Tests using it are skipped if that server can't be reached"""
+    from pymongo.database import Database
+    from pymongo.errors import PyMongoError
+    from utils import mongo
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(
+            mongo.Pool,
+            "database",
+            classmethod(lambda cls: Database(cls.client(), TEST_DATABASE)),
+        )
+        mongo.Pool.reset()
+        try:
+            mongo.Pool.client().admin.command("ping")
+        except PyMongoError as exc:
+            mongo.Pool.close()
+            pytest.skip(f"MongoDB not reachable: {exc!s}")
+
+        yield mongo
+
+        # metrics recorded meanwhile would otherwise be flushed to real database
+        mongo.metrics.REGISTRY.flush()
+        mongo.Pool.client().drop_database(TEST_DATABASE)
+        mongo.Pool.close()
+
+
+@pytest.fixture(scope="module")
+def app(database):
+    """scheduler's flask app, on the test database"""
+    import main
+
+    return main.flask
+
+
+@pytest.fixture(scope="module")
+def auth_headers(database):
+    """request headers authenticating a user (of role) named username"""
+    from utils.token import AccessToken
+
+    def headers(username, role="creator"):
+        return {"token": AccessToken.encode({"username": username, "role": role})}
+
+    return headers
@@ -0,0 +1,112 @@
+import datetime
+import threading
+
+import pytest
+from bson import ObjectId
+
+ON = datetime.datetime(2026, 6, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def emailing(database):
+    import emailing
+
+    database.Emails().create_indexes(database.Emails.indexes)
+    database.Emails().delete_many({})
+    return emailing
+
+
+class TestQueue:
+    def test_same_key_is_queued_once(self, database, emailing):
+        args = [str(ObjectId())]
+        assert database.Emails.queue("send_order_failed_email", args, key="k")
+        assert not database.Emails.queue("send_order_failed_email", args, key="k")
+
+        emails = list(database.Emails().find({"key": "k"}))
+        assert len(emails) == 1
+        assert emails[0]["status"] == database.Emails.pending
+        assert emails[0]["args"] == args
+
+    def test_concurrent_queues_of_same_key(self, database, emailing):
+        barrier = threading.Barrier(8)
+        results = []
+
+        def queue():
+            barrier.wait()
+            results.append(
+                database.Emails.queue("send_order_failed_email", [], key="race")
+            )
+
+        threads = [threading.Thread(target=queue) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(results) == [False] * 7 + [True]
+        assert database.Emails().count_documents({"key": "race"}) == 1
+
+
+class TestQueueEmail:
+    def test_key_is_scoped_to_transition(self, database, emailing):
+        order_id = ObjectId()
+        send = emailing.send_order_failed_email
+
+        assert emailing.queue_email(send, order_id, on=ON)
+        # worker retrying the same status update
+        assert not emailing.queue_email(send, order_id, on=ON)
+        # order failed again later (entering status again)
+        later = ON + datetime.timedelta(hours=1)
+        assert emailing.queue_email(send, order_id, on=later)
+
+        keys = [email["key"] for email in database.Emails().find()]
+        assert sorted(keys) == [
+            f"send_order_failed_email:{order_id}:{ON.isoformat()}",
+            f"send_order_failed_email:{order_id}:{later.isoformat()}",
+        ]
+
+    def test_without_transition_is_sent_once(self, database, emailing):
+        order_id = ObjectId()
+        send = emailing.send_order_failed_email
+
+        assert emailing.queue_email(send, order_id)
+        assert not emailing.queue_email(send, order_id)
+        assert emailing.queue_email(send, ObjectId())
+
+    def test_explicit_key(self, database, emailing):
+        send = emailing.send_order_failed_email
+
+        assert emailing.queue_email(send, ObjectId(), key="once")
+        assert not emailing.queue_email(send, ObjectId(), key="once")
+
+    def test_unknown_sender(self, emailing):
+        with pytest.raises(ValueError):
+            emailing.queue_email(print, "arg")
+
+
+class TestOutbox:
+    def test_claim_next_oldest_due(self, database, emailing):
+        database.Emails.queue("send_order_failed_email", ["first"], key="first")
+        database.Emails.queue("send_order_failed_email", ["second"], key="second")
+
+        email = database.Emails.claim_next(claim_for=60)
+        assert email["key"] == "first"
+        assert email["status"] == database.Emails.sending
+        assert email["attempts"] == 1
+        assert database.Emails.claim_next(claim_for=60)["key"] == "second"
+        assert database.Emails.claim_next(claim_for=60) is None
+
+    def test_failed_attempt_is_retried(self, database, emailing):
+        database.Emails.queue("send_order_failed_email", [], key="retried")
+        email = database.Emails.claim_next(claim_for=60)
+
+        database.Emails.set_failed(email["_id"], "down", retry_on=ON)
+        email = database.Emails().find_one({"_id": email["_id"]})
+        assert email["status"] == database.Emails.pending
+        assert email["next_attempt_on"] == ON
+        assert email["last_error"] == "down"
+
+        database.Emails.set_failed(email["_id"], "still down")
+        email = database.Emails().find_one({"_id": email["_id"]})
+        assert email["status"] == database.Emails.failed
+        assert email["expire_on"] > datetime.datetime.now()
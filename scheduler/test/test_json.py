@@ -0,0 +1,50 @@
+import datetime
+import json
+import uuid
+
+import pytest
+from bson import ObjectId
+from flask import Flask
+from utils.json import COMPACT_SEPARATORS, SchedulerJSONProvider
+
+
+@pytest.fixture(scope="module")
+def provider():
+    return SchedulerJSONProvider(Flask(__name__))
+
+
+def reference_dumps(obj):
+    return json.dumps(
+        obj,
+        default=SchedulerJSONProvider.default,
+        ensure_ascii=True,
+        sort_keys=True,
+        separators=COMPACT_SEPARATORS,
+    )
+
+
+@pytest.mark.parametrize(
+    "obj",
+    [
+        {"b": 1, "a": [None, True, False, "text"]},
+        {"ascii": "".join(chr(code) for code in range(128))},
+        {"del": "\x7f", "log": "line\x1b[0m\x7f"},
+        {"non-ascii": "éà…😀"},
+        {"float": 1.5, "exponent": 1e20, "small": 1e-7},
+        {"big": 2**64, "negative": -(2**63) - 1},
+        {1: "non-str key"},
+        {
+            "_id": ObjectId("000000000000000000000000"),
+            "on": datetime.datetime(2026, 1, 2, 3, 4, 5, 6),
+            "uuid": uuid.UUID(int=1),
+        },
+        [{"nested": [{"deep": ["value", 1, (2, 3)]}]}],
+    ],
+)
+def test_same_output_as_json(provider, obj):
+    assert provider.dumps(obj, separators=COMPACT_SEPARATORS) == reference_dumps(obj)
+
+
+def test_non_finite_floats(provider):
+    obj = {"nan": float("nan"), "inf": float("inf")}
+    assert provider.dumps(obj, separators=COMPACT_SEPARATORS) == reference_dumps(obj)
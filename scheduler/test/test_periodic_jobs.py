@@ -0,0 +1,95 @@
+import datetime
+import uuid
+
+import pytest
+
+INTERVAL = 300
+LEASE = 30
+
+
+@pytest.fixture(scope="module")
+def periodic_jobs(database):
+    return database.PeriodicJobs
+
+
+@pytest.fixture
+def name():
+    return f"job-{uuid.uuid4().hex}"
+
+
+def expire_lease(periodic_jobs, name):
+    periodic_jobs().update_one(
+        {"_id": name},
+        {"$set": {"lease_until": datetime.datetime.now() - datetime.timedelta(1)}},
+    )
+
+
+class TestLease:
+    def test_acquire(self, periodic_jobs, name):
+        token = periodic_jobs.start(name, INTERVAL, "replica-a", LEASE)
+        assert token == 1
+
+        job = periodic_jobs().find_one({"_id": name})
+        assert job["owner"] == "replica-a"
+        assert job["lease_until"] > datetime.datetime.now()
+
+    def test_leased_job_is_not_acquired(self, periodic_jobs, name):
+        periodic_jobs.start(name, INTERVAL, "replica-a", LEASE)
+
+        assert periodic_jobs.start(name, INTERVAL, "replica-b", LEASE) is None
+        assert (
+            periodic_jobs.start(name, INTERVAL, "replica-b", LEASE, force=True) is None
+        )
+
+    def test_expired_lease_is_not_held(self, periodic_jobs, name):
+        token = periodic_jobs.start(name, INTERVAL, "replica-a", LEASE)
+        assert periodic_jobs.holds(name, token)
+
+        expire_lease(periodic_jobs, name)
+        assert not periodic_jobs.holds(name, token)
+
+    def test_renew(self, periodic_jobs, name):
+        token = periodic_jobs.start(name, INTERVAL, "replica-a", LEASE)
+        lease_until = periodic_jobs().find_one({"_id": name})["lease_until"]
+
+        assert periodic_jobs.renew(name, token, LEASE * 2)
+        assert periodic_jobs().find_one({"_id": name})["lease_until"] > lease_until
+
+    def test_takeover_fences_stale_token(self, periodic_jobs, name):
+        stale_token = periodic_jobs.start(name, INTERVAL, "replica-a", LEASE)
+        expire_lease(periodic_jobs, name)
+
+        # job isn't due anymore: only acquired when forced
+        assert periodic_jobs.start(name, INTERVAL, "replica-b", LEASE) is None
+        token = periodic_jobs.start(name, INTERVAL, "replica-b", LEASE, force=True)
+        assert token == stale_token + 1
+
+        assert not periodic_jobs.holds(name, stale_token)
+        assert periodic_jobs.holds(name, token)
+        assert not periodic_jobs.renew(name, stale_token, LEASE)
+        assert not periodic_jobs.end(name, stale_token, duration=1)
+        job = periodic_jobs().find_one({"_id": name})
+        assert job["owner"] == "replica-b"
+        assert "nb_runs" not in job
+
+        assert periodic_jobs.renew(name, token, LEASE)
+        assert periodic_jobs.end(name, token, duration=2)
+
+    def test_end_records_run_and_releases(self, periodic_jobs, name):
+        token = periodic_jobs.start(name, INTERVAL, "replica-a", LEASE)
+        assert periodic_jobs.end(name, token, duration=2, error="boom")
+
+        job = periodic_jobs().find_one({"_id": name})
+        assert job["owner"] is None
+        assert job["lease_until"] is None
+        assert job["nb_runs"] == 1
+        assert job["nb_failures"] == 1
+        assert job["last_error"] == "boom"
+        assert periodic_jobs.last_durations()[name] == 2
+
+        # released but not due
+        assert periodic_jobs.start(name, INTERVAL, "replica-b", LEASE) is None
+        assert (
+            periodic_jobs.start(name, INTERVAL, "replica-b", LEASE, force=True)
+            == token + 1
+        )
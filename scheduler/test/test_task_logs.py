@@ -0,0 +1,83 @@
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture(scope="module")
+def task_logs(database):
+    database.TaskLogs().create_indexes(database.TaskLogs.indexes)
+    return database.TaskLogs
+
+
+class TestAppend:
+    def test_appends_at_stored_size(self, task_logs):
+        task_id = ObjectId()
+        assert task_logs.append(task_id, "worker", "hello ") == 6
+        assert task_logs.append(task_id, "worker", "world", offset=6) == 11
+        assert task_logs.get_logs([task_id]) == {task_id: {"worker": "hello world"}}
+
+    def test_gap_is_not_stored(self, task_logs):
+        task_id = ObjectId()
+        task_logs.append(task_id, "worker", "hello ")
+
+        # returned size tells sender where to resend from
+        assert task_logs.append(task_id, "worker", "world", offset=10) == 6
+        assert task_logs.get_logs([task_id]) == {task_id: {"worker": "hello "}}
+
+        assert task_logs.append(task_id, "worker", "world", offset=6) == 11
+        assert task_logs.get_logs([task_id]) == {task_id: {"worker": "hello world"}}
+
+    def test_overlap_only_stores_new_part(self, task_logs):
+        task_id = ObjectId()
+        task_logs.append(task_id, "worker", "hello wo")
+
+        assert task_logs.append(task_id, "worker", "world", offset=6) == 11
+        assert task_logs.get_logs([task_id]) == {task_id: {"worker": "hello world"}}
+
+    def test_duplicate_is_ignored(self, task_logs):
+        task_id = ObjectId()
+        task_logs.append(task_id, "worker", "hello ")
+        task_logs.append(task_id, "worker", "world", offset=6)
+
+        assert task_logs.append(task_id, "worker", "world", offset=6) == 11
+        assert task_logs.append(task_id, "worker", "hello world") == 11
+        assert task_logs().count_documents({"task": task_id}) == 2
+        assert task_logs.get_logs([task_id]) == {task_id: {"worker": "hello world"}}
+
+    def test_rewritten_full_log_replaces_stored(self, task_logs):
+        task_id = ObjectId()
+        # older workers resend whole logs, which aren't always extended
+        task_logs.append(task_id, "installer", "abc\n")
+
+        assert task_logs.append(task_id, "installer", "abcdef\n") == 7
+        assert task_logs.get_logs([task_id]) == {task_id: {"installer": "abcdef\n"}}
+
+        assert task_logs.append(task_id, "installer", "args\nabcdef\nok\n") == 15
+        assert task_logs.append(task_id, "installer", "args\n") == 15
+        assert task_logs.get_log(task_id, "installer") == "args\nabcdef\nok\n"
+
+    def test_full_log_extending_stored_is_appended(self, task_logs):
+        task_id = ObjectId()
+        task_logs.append(task_id, "worker", "hello ")
+
+        assert task_logs.append(task_id, "worker", "hello world") == 11
+        assert task_logs().count_documents({"task": task_id}) == 2
+
+    def test_kinds_are_independent(self, task_logs):
+        task_id = ObjectId()
+        task_logs.append(task_id, "worker", "hello")
+
+        assert task_logs.append(task_id, "installer", "setup", offset=5) == 0
+        assert task_logs.append(task_id, "installer", "setup") == 5
+        assert task_logs.get_logs([task_id]) == {
+            task_id: {"worker": "hello", "installer": "setup"}
+        }
+
+    def test_delete_for_task(self, task_logs):
+        task_id, other_id = ObjectId(), ObjectId()
+        task_logs.append(task_id, "worker", "hello")
+        task_logs.append(other_id, "worker", "hello")
+
+        assert task_logs.delete_for(task_id) == 1
+        assert task_logs.get_logs([task_id, other_id]) == {
+            other_id: {"worker": "hello"}
+        }
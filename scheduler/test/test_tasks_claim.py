@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+from bson import ObjectId
+
+NB_WORKERS = 8
+
+
+@pytest.fixture(scope="module")
+def creator_tasks(database):
+    return database.CreatorTasks
+
+
+@pytest.fixture
+def task_id(creator_tasks):
+    return (
+        creator_tasks()
+        .insert_one(
+            {
+                "order": "order",
+                "status": creator_tasks.pending,
+                "statuses": [],
+                "channel": None,
+                "worker": None,
+                "config_yaml": "name: test",
+            }
+        )
+        .inserted_id
+    )
+
+
+def race(func, nb):
+    """results of func(index) called at once from nb threads"""
+    barrier = threading.Barrier(nb)
+    results = [None] * nb
+
+    def run(index):
+        barrier.wait()
+        results[index] = func(index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(nb)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestRegister:
+    def test_single_winner(self, creator_tasks, task_id):
+        results = race(
+            lambda index: creator_tasks.register(task_id, {"username": f"w{index}"}),
+            NB_WORKERS,
+        )
+
+        winners = [index for index, task in enumerate(results) if task is not None]
+        assert len(winners) == 1
+        task = creator_tasks().find_one({"_id": task_id})
+        assert task["status"] == creator_tasks.received
+        assert task["worker"] == f"w{winners[0]}"
+        assert len(task["statuses"]) == 1
+
+    def test_task_assigned_to_other_worker(self, creator_tasks, task_id):
+        creator_tasks().update_one({"_id": task_id}, {"$set": {"worker": "w0"}})
+
+        assert creator_tasks.register(task_id, {"username": "w1"}) is None
+        assert creator_tasks.register(task_id, {"username": "w0"})["worker"] == "w0"
+
+
+class TestRequestRoute:
+    @pytest.fixture
+    def request_task(self, app, auth_headers):
+        def request_task(task_id, username):
+            # a client per request: requests are sent from several threads
+            return app.test_client().patch(
+                f"/tasks/creator/{task_id}/request", headers=auth_headers(username)
+            )
+
+        return request_task
+
+    def test_loser_gets_conflict(self, creator_tasks, request_task, task_id):
+        responses = race(lambda index: request_task(task_id, f"w{index}"), NB_WORKERS)
+
+        statuses = sorted(response.status_code for response in responses)
+        assert statuses == [200] + [409] * (NB_WORKERS - 1)
+        winner = next(
+            response.get_json() for response in responses if response.status_code == 200
+        )
+        assert winner["_id"] == str(task_id)
+        assert winner["status"] == creator_tasks.received
+
+    def test_missing_task(self, request_task):
+        assert request_task(ObjectId(), "w0").status_code == 404
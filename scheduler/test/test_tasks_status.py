@@ -0,0 +1,138 @@
+import datetime
+
+import pytest
+
+IMAGE = {"fname": "image.img", "size": 2**30, "checksum": "md5:1234"}
+
+
+@pytest.fixture
+def order_id(database):
+    return (
+        database.Orders()
+        .insert_one(
+            {
+                "channel": "kiwix",
+                "fname": "order",
+                "quantity": 2,
+                "sd_card": {"duration": 7},
+                "warehouse": {"download_uris": ["https://download.example.org"]},
+                "status": database.Orders.creating,
+                "statuses": [],
+                "tasks": {},
+            }
+        )
+        .inserted_id
+    )
+
+
+@pytest.fixture
+def creator_task_id(database, order_id):
+    task_id = (
+        database.CreatorTasks()
+        .insert_one(
+            {
+                "order": order_id,
+                "channel": "kiwix",
+                "worker": "creator",
+                "status": database.Tasks.built,
+                "statuses": [
+                    {"status": database.Tasks.built, "on": datetime.datetime.now()}
+                ],
+                "image": IMAGE,
+            }
+        )
+        .inserted_id
+    )
+    database.Orders().update_one({"_id": order_id}, {"$set": {"tasks.create": task_id}})
+    return task_id
+
+
+@pytest.fixture
+def update_status(app, auth_headers):
+    def update_status(task_type, task_id, status, username="creator", role="creator"):
+        return app.test_client().patch(
+            f"/tasks/{task_type}/{task_id}/status",
+            json={"status": status, "log": None},
+            headers=auth_headers(username, role),
+        )
+
+    return update_status
+
+
+class TestUploaded:
+    def test_downloader_task_gets_image(
+        self, database, update_status, order_id, creator_task_id
+    ):
+        Tasks = database.Tasks
+        for status in (Tasks.uploading, Tasks.uploaded):
+            assert update_status("creator", creator_task_id, status).status_code == 200
+
+        order = database.Orders.get(order_id)
+        assert order["status"] == database.Orders.pending_writer
+        downloader_task = database.DownloaderTasks().find_one(
+            {"_id": order["tasks"]["download"]}
+        )
+        assert downloader_task["status"] == Tasks.pending
+        assert downloader_task["image_fname"] == IMAGE["fname"]
+        assert downloader_task["image_size"] == IMAGE["size"]
+        assert downloader_task["image_checksum"] == IMAGE["checksum"]
+        assert downloader_task["expected_size"] == IMAGE["size"]
+
+    def test_writer_tasks_get_image(
+        self, database, update_status, order_id, creator_task_id
+    ):
+        Tasks = database.Tasks
+        for status in (Tasks.uploading, Tasks.uploaded):
+            update_status("creator", creator_task_id, status)
+        download_id = database.Orders.get(order_id)["tasks"]["download"]
+        database.DownloaderTasks().update_one(
+            {"_id": download_id}, {"$set": {"worker": "writer"}}
+        )
+
+        for status in (Tasks.downloading, Tasks.downloaded):
+            response = update_status(
+                "downloader", download_id, status, username="writer", role="writer"
+            )
+            assert response.status_code == 200
+
+        writer_tasks = list(database.WriterTasks().find({"order": order_id}))
+        assert len(writer_tasks) == 2
+        for writer_task in writer_tasks:
+            assert writer_task["image_fname"] == IMAGE["fname"]
+            assert writer_task["image_size"] == IMAGE["size"]
+            assert writer_task["image_checksum"] == IMAGE["checksum"]
+
+
+class TestTransitions:
+    def test_repeated_status_has_no_side_effects(
+        self, database, update_status, order_id, creator_task_id
+    ):
+        Tasks = database.Tasks
+        for status in (Tasks.uploading, Tasks.uploaded):
+            update_status("creator", creator_task_id, status)
+        nb_emails = database.Emails().count_documents({})
+
+        # worker retrying after a lost response
+        response = update_status("creator", creator_task_id, Tasks.uploaded)
+        assert response.status_code == 200
+        assert response.get_json() == {"_id": str(creator_task_id)}
+
+        assert database.DownloaderTasks().count_documents({"order": order_id}) == 1
+        assert database.Emails().count_documents({}) == nb_emails
+        task = database.CreatorTasks().find_one({"_id": creator_task_id})
+        assert [entry["status"] for entry in task["statuses"]] == [
+            Tasks.built,
+            Tasks.uploading,
+            Tasks.uploaded,
+        ]
+
+    def test_disallowed_status_conflicts(
+        self, database, update_status, creator_task_id
+    ):
+        Tasks = database.Tasks
+        response = update_status("creator", creator_task_id, Tasks.received)
+        assert response.status_code == 409
+
+        task = database.CreatorTasks().find_one({"_id": creator_task_id})
+        assert task["status"] == Tasks.built
+        assert len(task["statuses"]) == 1
@@ -0,0 +1,94 @@
+import datetime
+
+import pytest
+
+
+@pytest.fixture
+def new_task(database):
+    def new_task(status):
+        return (
+            database.CreatorTasks()
+            .insert_one(
+                {
+                    "order": None,
+                    "status": status,
+                    "statuses": [{"status": status, "on": datetime.datetime.now()}],
+                }
+            )
+            .inserted_id
+        )
+
+    return new_task
+
+
+class TestTaskTransitions:
+    def test_pushes_status(self, database, new_task):
+        tasks = database.CreatorTasks
+        task_id = new_task(tasks.received)
+        on = datetime.datetime(2026, 1, 2, 3, 4, 5)
+
+        previous = tasks.update_status(task_id, tasks.building, payload="go", on=on)
+        assert previous["status"] == tasks.received
+
+        task = tasks().find_one({"_id": task_id})
+        assert task["status"] == tasks.building
+        assert task["statuses"][-1] == {
+            "status": tasks.building,
+            "on": on,
+            "payload": "go",
+        }
+        # entering an in-progress status sets its deadline
+        assert task["deadline"] > on
+
+    def test_same_status_is_skipped(self, database, new_task):
+        tasks = database.CreatorTasks
+        task_id = new_task(tasks.building)
+
+        assert tasks.update_status(task_id, tasks.building) is None
+        assert len(tasks().find_one({"_id": task_id})["statuses"]) == 1
+
+    def test_disallowed_transitions(self, database, new_task):
+        tasks = database.CreatorTasks
+        # received is only reached from pending, timedout from in-progress ones
+        building_id, uploaded_id = new_task(tasks.building), new_task(tasks.uploaded)
+
+        assert tasks.update_status(building_id, tasks.received) is None
+        assert tasks.update_status(uploaded_id, tasks.timedout) is None
+        assert tasks().find_one({"_id": uploaded_id})["status"] == tasks.uploaded
+
+        assert tasks.update_status(building_id, tasks.timedout)
+
+    def test_transition_many(self, database, new_task):
+        tasks = database.CreatorTasks
+        task_ids = [new_task(tasks.building), new_task(tasks.uploaded)]
+
+        assert tasks.transition_many({"_id": {"$in": task_ids}}, tasks.timedout) == 1
+        assert [
+            task["status"] for task in tasks().find({"_id": {"$in": task_ids}})
+        ] == [tasks.timedout, tasks.uploaded]
+
+
+class TestOrderTransitions:
+    @pytest.fixture
+    def new_order(self, database):
+        def new_order(status):
+            return (
+                database.Orders()
+                .insert_one({"status": status, "statuses": []})
+                .inserted_id
+            )
+
+        return new_order
+
+    def test_expired_only_from_pending_expiry(self, database, new_order):
+        orders = database.Orders
+        creating_id = new_order(orders.creating)
+        pending_id = new_order(orders.pending_expiry)
+
+        assert orders.update_status(creating_id, orders.expired) is None
+        assert orders.update_status(pending_id, orders.expired)
+        assert orders.update_status(pending_id, orders.expired) is None
+        assert [
+            entry["status"]
+            for entry in orders().find_one({"_id": pending_id})["statuses"]
+        ] == [orders.expired]
@@ -0,0 +1,95 @@
+import datetime
+import itertools
+
+import pytest
+
+NOW = datetime.datetime(2026, 6, 1)
+DAY = datetime.timedelta(days=1)
+
+
+@pytest.fixture
+def new_file(database):
+    """add an uploaded file (confirmed by default), returning its download URL"""
+    database.UploadedFiles().delete_many({})
+    counter = itertools.count()
+
+    def new_file(status="confirmed", **fields):
+        url = f"https://download.example.org/{next(counter)}.img"
+        document = {"status": status, "upload_url": url, "download_url": url}
+        document.update(fields)
+        database.UploadedFiles().insert_one(document)
+        return url
+
+    return new_file
+
+
+def urls(files):
+    return sorted(file["download_url"] for file in files)
+
+
+class TestExpiryQueries:
+    def test_all_expired(self, database, new_file):
+        expired = new_file(expire_on=NOW - DAY)
+        new_file(expire_on=NOW + DAY)
+        new_file(expire_on=None)
+        new_file(status="pending", expire_on=NOW - DAY)
+
+        assert urls(database.UploadedFiles.all_expired(NOW)) == [expired]
+
+    def test_all_expiring(self, database, new_file):
+        soon = new_file(expire_on=NOW + DAY)
+        unknown = new_file(expire_on=None)
+        later = new_file(expire_on=NOW + 30 * DAY)
+        new_file(status="pending", expire_on=NOW + DAY)
+
+        before = NOW + 7 * DAY
+        assert urls(database.UploadedFiles.all_expiring(before)) == [soon, unknown]
+        assert urls(
+            database.UploadedFiles.all_expiring(before, download_urls=[soon, later])
+        ) == [soon]
+
+    def test_earliest_expiry(self, database, new_file):
+        files = [
+            new_file(expire_on=NOW + 3 * DAY),
+            new_file(expire_on=NOW + DAY),
+            new_file(expire_on=None),
+        ]
+        assert database.UploadedFiles.earliest_expiry(files) == NOW + DAY
+        assert database.UploadedFiles.earliest_expiry(files[2:]) is None
+
+    def test_all_unchecked_since(self, database, new_file):
+        never = new_file()
+        old = new_file(checked_on=NOW - 30 * DAY)
+        new_file(checked_on=NOW - 10 * DAY)
+        new_file(checked_on=NOW)
+
+        found = database.UploadedFiles.all_unchecked_since(NOW - 7 * DAY, limit=2)
+        # never checked first
+        assert [file["download_url"] for file in found] == [never, old]
+
+    def test_set_expire_on(self, database, new_file):
+        url = new_file()
+        file_id = database.UploadedFiles.get_or_none(url)["_id"]
+
+        database.UploadedFiles.set_expire_on(file_id, NOW + DAY)
+        file = database.UploadedFiles.get_or_none(url)
+        assert file["expire_on"] == NOW + DAY
+        assert "checked_on" not in file
+
+        database.UploadedFiles.set_expire_on(file_id, NOW + 2 * DAY, checked_on=NOW)
+        file = database.UploadedFiles.get_or_none(url)
+        assert (file["expire_on"], file["checked_on"]) == (NOW + 2 * DAY, NOW)
+
+
+class TestAutoImageRoute:
+    def test_autodelete_on_from_recorded_expiry(
+        self, database, app, auth_headers, new_file
+    ):
+        files = [new_file(expire_on=NOW + 3 * DAY), new_file(expire_on=NOW + DAY)]
+        database.AutoImages().insert_one({"slug": "expiring", "http_urls": files})
+
+        response = app.test_client().get(
+            "/auto-images/expiring", headers=auth_headers("manager", "manager")
+        )
+        assert response.status_code == 200
+        assert response.get_json()["autodelete_on"] == (NOW + DAY).isoformat()
@@ -28,6 +28,8 @@ class CreatorWorker:
         self.job: CreateTask = None
         self.log_stream: io.StringIO = None  # stores worker log during job
         self.log_handler: logging.Handler = None  # handles logging during job
+        self.log_offsets: dict = {}  # size of each log stored by scheduler
+        self.log_bytes: dict = {}  # log bytes sent and full logs size (for stats)
 
     def start(self):
         logger.info("Welcome to Imager worker:")
@@ -55,6 +57,8 @@ class CreatorWorker:
     def start_task(self, task):
         self._attach_logger()
         self.task = task
+        self.log_offsets = {}
+        self.log_bytes = {"sent": 0, "full": 0}
 
         logger.info("Starting to work on {}".format(self.task["_id"]))
         self.job = CreateTask(args=(self.task, logger))
@@ -85,13 +89,44 @@ class CreatorWorker:
         return tasks
 
     def request_task(self, task_id):
+        """full task if we could claim it, None otherwise"""
         logger.info("requesting task #{} to scheduler.".format(task_id))
-        success, tid = request_task(task_id)
-        return success
+        success, task = request_task(task_id)
+        if not success:
+            return None
+        # older schedulers only returned the task ID
+        if "config_yaml" not in task:
+            success, task = get_task(task_id)
+            if not success:
+                logger.error("ERROR getting task #{}: {}".format(task_id, task))
+                return None
+        return task
 
     def upload_worker_logs(self, logs):
+        """send logs' parts that the scheduler doesn't have yet"""
         logger.info("sending logs for task #{}.".format(self.task["_id"]))
-        success, tid = upload_logs(task_id=self.task["_id"], logs=logs)
+        offsets, new_logs = {}, {}
+        # job thread updates its logs meanwhile
+        for key, value in list(logs.items()):
+            if value is None:
+                continue
+            kind = key[: -len("_log")]
+            offsets[kind] = min(self.log_offsets.get(kind, 0), len(value))
+            new_logs[key] = value[offsets[kind] :]
+            self.log_bytes["sent"] += len(new_logs[key].encode("utf-8"))
+            self.log_bytes["full"] += len(value.encode("utf-8"))
+
+        success, response = upload_logs(
+            task_id=self.task["_id"], logs=new_logs, offsets=offsets
+        )
+        if not success:
+            logger.error("ERROR sending logs: {}".format(response))
+            return
+
+        # scheduler tells what it has. if there was a gap, we'll resend from there.
+        # older schedulers don't and expect full logs every time
+        for kind, size in response.get("sizes", {}).items():
+            self.log_offsets[kind] = size
 
     def send_ack(self):
         logger.info("sending ACK to scheduler. working on #{}".format(self.task["_id"]))
@@ -115,6 +150,11 @@ class CreatorWorker:
         if self.job:
             logs.update(self.job.logs)
         self.upload_worker_logs(logs)
+        logger.info(
+            "sent {sent} bytes of logs for task #{id} (would have been {full})".format(
+                id=self.task["_id"], **self.log_bytes
+            )
+        )
         # clean-up
         self.job = None
         self.task = None
@@ -160,27 +200,20 @@ class CreatorWorker:
                     self.cleanup_task()
             else:
                 if not poll_timer.pop():
-                    # fetch tasks on scheduler
+                    # fetch tasks on scheduler (already filtered for us)
                     for task in self.get_available_tasks():
                         # skip tasks that are scheduled for other workers
-                        try:
-                            if (
-                                task["worker"] is not None
-                                and task["worker"] != Setting.username
-                            ):
-                                continue
-                            if not task.get("config_yaml", ""):
-                                continue
-                        except Exception:
-                            pass
+                        if task.get("worker") not in (None, Setting.username):
+                            continue
 
                         # notify scheduler we want to take it
-                        if self.request_task(task["_id"]):
-                            self.start_task(task)
+                        # list only has summaries ; claim returns full task
+                        full_task = self.request_task(task["_id"])
+                        if full_task:
+                            self.start_task(full_task)
                             break
                     poll_timer = Setting.get_timer(Setting.poll_interval)
 
             time.sleep(1)
 
         logger.info("exiting gracefuly.")
-
@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import codecs
 import io
 import logging
 import re
 import subprocess
 import tempfile
 import threading
+import time
 import urllib.parse
 from pathlib import Path
 
@@ -70,12 +72,6 @@ class CreateTask(threading.Thread):
     def file_path(self, ext):
         return Setting.working_dir.joinpath(self.task["fname"]).with_suffix(f".{ext}")
 
-    def read_log(self, path):
-        cat = subprocess.run(["cat", str(path)], text=True, capture_output=True)
-        return "{stdout}\n{stderr}".format(
-            stdout=cat.stdout or "", stderr=cat.stderr or ""
-        )
-
     def remove_files(self, only_errorneous=True):
         suffixes = [".ERROR.img", ".BUILDING.img"]
         if not only_errorneous:
@@ -213,9 +209,15 @@ class CreateTask(threading.Thread):
             close_fds=True,
         )
 
+        # installer log only grows: keep appending what's new in the file.
+        # a character being written may be incomplete: decoder keeps its bytes
+        log_reader = open(str(self.log_path), "rb")
+        log_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
         self.logger.info("installer started: {}".format(ps))
         while ps.poll() is None:
-            self.logs["installer_log"] = self.read_log(self.log_path)
+            self.logs["installer_log"] += log_decoder.decode(log_reader.read())
+            time.sleep(1)
 
             # kill upon request
             if self.canceled:
@@ -242,7 +244,9 @@ class CreateTask(threading.Thread):
             self.logger.error("installer failed: {}".format(ps.returncode))
 
         self.logger.info("collecting full terminated log")
-        self.logs["installer_log"] = self.read_log(self.log_path)
+        self.logs["installer_log"] += log_decoder.decode(log_reader.read(), final=True)
+        log_reader.close()
+        log_fd.close()
 
         # clean up working folder
         build_dir.cleanup()
@@ -360,7 +364,9 @@ class CreateTask(threading.Thread):
         try:
             res = multi_file_upload(
                 src_path=file_path,
-                upload_urls=self.get_upload_urls(with_credentials=True, with_fname=False),
+                upload_urls=self.get_upload_urls(
+                    with_credentials=True, with_fname=False
+                ),
                 private_key=Setting.ssh_key_path,
                 delete=True,
                 delete_after=delete_after,
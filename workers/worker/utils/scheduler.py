@@ -130,7 +130,10 @@ def test_connection():
 
 @auth_required
 def get_available_tasks(slot=None):
-    success, code, response = query_api(GET, "/tasks/{}".format(WORKER_TYPE))
+    # summaries only: full task is retrieved once claimed
+    success, code, response = query_api(
+        GET, "/tasks/{}?fields=summary".format(WORKER_TYPE)
+    )
     return success, response
 
 
@@ -162,15 +165,16 @@ def update_task_status(task_id, status, log=None, extra={}):
 
 
 @auth_required
-def upload_logs(task_id, logs={}):
-    for key, value in logs.items():
-        if value is None:
-            del logs[key]
+def upload_logs(task_id, logs={}, offsets=None):
+    """send logs, each found at its offsets' entry (whole log if missing)"""
+    payload = {key: value for key, value in logs.items() if value is not None}
+    if offsets:
+        payload["offsets"] = offsets
 
     success, code, response = query_api(
         POST,
         "/tasks/{type}/{id}/logs".format(type=WORKER_TYPE, id=task_id),
-        payload=logs,
+        payload=payload,
     )
     return success, response
 